@@ -1,10 +1,38 @@
 #! /usr/bin/env python
 import sys
 import os
+import re
+import json
+import hashlib
+import threading
+from glob import glob
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from subprocess import call, check_call, PIPE, Popen
+import xml.etree.ElementTree as ET
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import SafeConfigParser as ConfigParser
 
 SCRATCH = os.path.join('/glade/scratch', os.environ['USER'])
 
+# local mirrors of the CESM repository and its externals, see `CodeCache`
+GIT_CACHE = os.environ.get('CESM_GIT_CACHE', os.path.join('/glade/work', os.environ['USER'],
+                                                          'git-cache'))
+
+# builds shared between cases, see `BuildRegistry`; kept apart from the
+# case directories, so that removing a case does not remove its build
+BUILD_ROOT = os.path.join(SCRATCH, 'cesm_builds')
+
+# case settings that determine the build, in addition to the code tag and
+# the SourceMods; component settings are queried for each of COMPONENTS
+BUILD_SETTINGS = ['COMPSET', 'GRID', 'MACH', 'COMPILER', 'MPILIB', 'DEBUG',
+                  'OCN_TRACER_MODULES', 'POP_BLCKX', 'POP_BLCKY', 'POP_MXBLCKS',
+                  'POP_DECOMPTYPE', 'POP_NX_BLOCKS', 'POP_NY_BLOCKS']
+PE_SETTINGS = ['NTASKS', 'NTHRDS', 'ROOTPE']
+COMPONENTS = ['ATM', 'LND', 'ICE', 'OCN', 'ROF', 'GLC', 'WAV', 'CPL', 'ESP']
+
 class defcase(object):
     def __init__(self, compref, compset, res, note, ens, croot):
         name_parts = [compref, compset, res]
@@ -46,76 +74,615 @@ def xmlquery(xmlvar):
     cmd = ['./xmlquery', xmlvar]
     p = Popen(cmd, stdin=None, stdout=PIPE,  stderr=PIPE)
     stdout, stderr = p.communicate()
+    stdout = stdout.decode('UTF-8')
+    stderr = stderr.decode('UTF-8')
     if stderr:
         print(stderr)
         sys.exit(1)
-    return stdout.split(':')[1].strip()
+    return stdout.split(':', 1)[1].strip()
+
+
+class CaseConfig(object):
+    """Read and change the env_*.xml settings of a case in-process.
+
+    All env files are parsed once; `change` validates and applies settings
+    in memory and `write` saves each modified file once, in place of one
+    ./xmlchange or ./xmlquery process (each re-reading the case) per
+    variable. Component settings are addressed as with xmlchange, e.g.
+    NTASKS_OCN is the OCN value of entry NTASKS.
+
+    Intended for settings made before ./case.setup; unlike ./xmlchange it
+    does not reset or lock anything.
+    """
+
+    def __init__(self, caseroot='.'):
+        self.caseroot = caseroot
+        self._trees = OrderedDict()
+        for path in sorted(glob(os.path.join(caseroot, 'env_*.xml'))):
+            self._trees[os.path.basename(path)] = _parse(path)
+        self._modified = set()
+
+    def _lookup(self, var, file_name='', subgroup=''):
+        """Return a list of (file, entry, compclass) matching `var`."""
+        def find(entry_id, compclass):
+            matches = []
+            for fname, tree in self._trees.items():
+                if file_name and fname != os.path.basename(file_name):
+                    continue
+                for group in tree.getroot().iter('group'):
+                    if subgroup and group.get('id') != subgroup:
+                        continue
+                    for entry in group.findall('entry'):
+                        if entry.get('id') != entry_id:
+                            continue
+                        if compclass is not None and _compclass_value(entry, compclass) is None:
+                            continue
+                        matches.append((fname, entry, compclass))
+            return matches
+
+        matches = find(var, None)
+        if not matches and '_' in var:
+            entry_id, compclass = var.rsplit('_', 1)
+            matches = find(entry_id, compclass)
+        if not matches:
+            raise KeyError('%s not found in %s' % (var, self.caseroot))
+        return matches
+
+    def get(self, var, file_name='', subgroup=''):
+        """Return the value of `var` as a string (see ./xmlquery --value).
+
+        For a component entry addressed without a component (NTASKS rather
+        than NTASKS_OCN), the value is that of all components; it is an
+        error if they differ.
+        """
+        fname, entry, compclass = self._lookup(var, file_name, subgroup)[0]
+        if compclass is not None:
+            return _compclass_value(entry, compclass).text.strip()
+
+        values = _entry_values(var, entry)
+        if values is None:
+            return entry.get('value')
+        texts = set((value.text or '').strip() for value in values)
+        if len(texts) > 1:
+            raise ValueError('%s differs between components; query one of %s'
+                             % (var, ', '.join('%s_%s' % (var, value.get('compclass'))
+                                               for value in values)))
+        return texts.pop()
+
+    def resolve(self, var, file_name='', subgroup=''):
+        """Return the value of `var` with $VAR references expanded from
+        the case settings or the environment."""
+        def expand(match):
+            try:
+                return self.resolve(match.group(1))
+            except KeyError:
+                return os.environ.get(match.group(1), match.group(0))
+        return _var_ref.sub(expand, self.get(var, file_name, subgroup))
+
+    def set(self, var, val, file_name='', subgroup=''):
+        """Validate and set `var` to `val` in every matching entry."""
+        val = _xml_value(val)
+        for fname, entry, compclass in self._lookup(var, file_name, subgroup):
+            _validate(var, val, entry)
+            if compclass is not None:
+                _compclass_value(entry, compclass).text = val
+            else:
+                values = _entry_values(var, entry)
+                if values is None:
+                    entry.set('value', val)
+                else:
+                    # all components, as ./xmlchange does
+                    for value in values:
+                        value.text = val
+            self._modified.add(fname)
+
+    def change(self, xmlsetting, file_name='', subgroup=''):
+        """Set each variable in dictionary `xmlsetting` (see `xmlchange`)."""
+        for var, val in xmlsetting.items():
+            print('%s = %s' % (var, _xml_value(val)))
+            self.set(var, val, file_name, subgroup)
+
+    def write(self):
+        """Write the modified env files."""
+        for fname in sorted(self._modified):
+            self._trees[fname].write(os.path.join(self.caseroot, fname),
+                                     encoding='UTF-8', xml_declaration=True)
+        self._modified = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.write()
+
+
+def _parse(path):
+    """Parse an env file keeping its comments, so that `write` preserves
+    them (Python 3.8 and later)."""
+    try:
+        parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+    except TypeError:
+        parser = None
+    return ET.parse(path, parser)
+
+
+_var_ref = re.compile(r'\$\{?(\w+)\}?')
+
+
+def _xml_value(val):
+    """Format a setting as xmlchange does."""
+    if type(val) == bool:
+        return str(val).upper()
+    return str(val)
+
 
+def _entry_values(var, entry):
+    """Return the <value> elements of a component entry, None for an entry
+    with a value attribute."""
+    values = list(entry.iter('value'))
+    if values:
+        return values
+    if entry.get('value') is None:
+        raise ValueError('%s has no value' % var)
+    return None
 
 
-def user_nl_append(user_nl):
+def _compclass_value(entry, compclass):
+    """Return the <value compclass=...> element of `entry`, if any."""
+    for value in entry.iter('value'):
+        if value.get('compclass') == compclass:
+            return value
+    return None
+
+
+def _validate(var, val, entry):
+    """Check `val` against the type and valid_values of `entry`."""
+    vtype = entry.findtext('type', default='char').strip()
+    try:
+        if vtype == 'integer':
+            int(val)
+        elif vtype == 'real':
+            float(val)
+        elif vtype == 'logical' and val.upper() not in ['TRUE', 'FALSE']:
+            raise ValueError
+    except ValueError:
+        raise ValueError('%s: %s is not of type %s' % (var, val, vtype))
+
+    valid_values = entry.findtext('valid_values')
+    if valid_values and valid_values.strip():
+        valid = [v.strip() for v in valid_values.split(',')]
+        if val not in valid:
+            raise ValueError('%s: %s is not one of %s' % (var, val, valid))
+
+
+
+def build_settings(caseroot, tag):
+    """Return the settings that determine the build of a case: `tag`, the
+    BUILD_SETTINGS and PE layout present in the case and the sha1 of each
+    file in SourceMods. Call after ./case.setup.
+    """
+    config = CaseConfig(caseroot)
+    settings = {'tag': tag}
+    names = BUILD_SETTINGS + ['%s_%s' % (pe, comp) for pe in PE_SETTINGS for comp in COMPONENTS]
+    for var in names:
+        try:
+            settings[var] = config.get(var)
+        except KeyError:
+            pass
+
+    sourcemods = {}
+    srcroot = os.path.join(caseroot, 'SourceMods')
+    for path in sorted(glob(os.path.join(srcroot, 'src.*', '*'))):
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                sourcemods[os.path.relpath(path, srcroot)] = hashlib.sha1(f.read()).hexdigest()
+    settings['sourcemods'] = sourcemods
+    return settings
+
+
+def build_hash(settings, sourcemods=True):
+    """Hash `build_settings`; with `sourcemods=False`, hash all but the
+    SourceMods."""
+    if not sourcemods:
+        settings = dict((k, v) for k, v in settings.items() if k != 'sourcemods')
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+class BuildRegistry(object):
+    """Completed builds in `root`, one directory per `build_hash`, listed in
+    `root`/registry.json as {hash: {'settings': ..., 'exeroot': ...,
+    'case': ...}}.
+
+    A case with the `build_hash` of a registered build can run that build
+    as is (`share_build`). A case that differs from a registered build only
+    in a few Fortran SourceMods can start from a copy of it and recompile
+    just those files (`clone_build`).
+    """
+
+    def __init__(self, root=BUILD_ROOT):
+        self.root = root
+        self.path = os.path.join(root, 'registry.json')
+        self._lock = threading.Lock()
+
+    def build_dir(self, settings):
+        """Return the EXEROOT for a build with `settings`."""
+        return os.path.join(self.root, build_hash(settings), 'bld')
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            builds = json.load(f)
+        # skip builds that have since been removed
+        return dict((key, build) for key, build in builds.items()
+                    if os.path.exists(os.path.join(build['exeroot'], 'cesm.exe')))
+
+    def find(self, settings):
+        """Return the build with `settings`, or None."""
+        with self._lock:
+            return self._read().get(build_hash(settings))
+
+    def nearest(self, settings, max_changed=1):
+        """Return the build and the list of SourceMods that differ, for the
+        build with the same settings but for at most `max_changed` changed
+        or added Fortran SourceMods; (None, None) if there is none.
+        """
+        base = build_hash(settings, sourcemods=False)
+        with self._lock:
+            builds = self._read()
+
+        nearest, nearest_changed = None, None
+        for build in builds.values():
+            if build_hash(build['settings'], sourcemods=False) != base:
+                continue
+            old, new = build['settings']['sourcemods'], settings['sourcemods']
+            # a removed SourceMod would leave its object file in the build
+            if any(f not in new for f in old):
+                continue
+            changed = sorted(f for f in new if old.get(f) != new[f])
+            if len(changed) > max_changed:
+                continue
+            if not all(os.path.splitext(f)[1] in ['.F90', '.F'] for f in changed):
+                continue
+            if nearest is None or len(changed) < len(nearest_changed):
+                nearest, nearest_changed = build, changed
+        return nearest, nearest_changed
+
+    def register(self, settings, caseroot):
+        """Add the completed build of the case in `caseroot`."""
+        exeroot = CaseConfig(caseroot).resolve('EXEROOT')
+        with self._lock:
+            builds = self._read()
+            builds[build_hash(settings)] = {'settings': settings, 'exeroot': exeroot,
+                                            'case': os.path.basename(caseroot)}
+            check_call(['mkdir', '-p', self.root])
+            with open(self.path+'.tmp', 'w') as f:
+                json.dump(builds, f, indent=1, sort_keys=True)
+            os.rename(self.path+'.tmp', self.path)
+
+
+def share_build(caseroot, exeroot):
+    """Point the case at the completed build in `exeroot`."""
+    with CaseConfig(caseroot) as config:
+        config.change({'EXEROOT': exeroot, 'BUILD_COMPLETE': True})
+
+
+def clone_build(caseroot, exeroot, changed):
+    """Copy the build in `exeroot` to the build directory of the case,
+    so that ./case.build only recompiles the `changed` SourceMods (and the
+    files that depend on them) and relinks.
+    """
+    case_exeroot = CaseConfig(caseroot).resolve('EXEROOT')
+    check_call(['rm', '-fr', case_exeroot])
+    check_call(['mkdir', '-p', os.path.dirname(case_exeroot)])
+    check_call(['cp', '-a', exeroot, case_exeroot])
+
+    # make the changed sources newer than the copied objects
+    for f in changed:
+        os.utime(os.path.join(caseroot, 'SourceMods', f), None)
+
+
+def user_nl_append(user_nl, caseroot='.'):
     for mdl, nml in user_nl.items():
         print('writing to: '+'user_nl_'+mdl)
-        with open('user_nl_'+mdl, 'a') as fid:
+        with open(os.path.join(caseroot, 'user_nl_'+mdl), 'a') as fid:
             for l in nml:
                 print(l)
                 fid.write('%s\n'%l)
         print('')
 
 
-def code_checkout(cesm_repo, coderoot, tag):
-    """Checkout code for CESM
-    If sandbox exists, check that the right tag has been checked-out.
+def _git(args, cwd=None):
+    """Run git and return its stripped output."""
+    p = Popen(['git'] + args, cwd=cwd, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise Exception('git error: git %s: %s' % (' '.join(args), stderr.decode('UTF-8').strip()))
+    return stdout.decode('UTF-8').strip()
+
 
-    Otherwise, download the code, checkout the tag and run manage_externals.
+class CodeCache(object):
+    """Local bare mirrors of git repositories, from which sandboxes are
+    checked out without going to the network.
 
-    The scripts don't seem to like multiple applications of manage_externals.
+    Each repository is mirrored once into `cache_dir` and fetched again
+    only when a requested ref is missing. Sandboxes are `git clone --shared`
+    from the mirror, so they take no space for objects and need the mirror
+    to stay in place.
     """
 
-    sandbox = os.path.split(coderoot)[-1]
+    def __init__(self, cache_dir=GIT_CACHE):
+        self.cache_dir = cache_dir
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def mirror(self, url, ref):
+        """Mirror `url` so that it has `ref`; return the mirror path and the
+        commit hash of `ref`.
+        """
+        path = os.path.join(self.cache_dir, re.sub(r'[^\w.-]+', '_', url.split('://')[-1]))
+        if not path.endswith('.git'):
+            path += '.git'
+
+        with self._lock:
+            lock = self._locks.setdefault(path, threading.Lock())
+        with lock:
+            if not os.path.exists(path):
+                print('mirroring %s' % url)
+                check_call(['mkdir', '-p', self.cache_dir])
+                _git(['clone', '-q', '--mirror', url, path])
+            try:
+                commit = _git(['rev-parse', '--verify', '-q', ref+'^{commit}'], cwd=path)
+            except Exception:
+                print('updating the mirror of %s' % url)
+                _git(['fetch', '-q', '--prune'], cwd=path)
+                commit = _git(['rev-parse', '--verify', '-q', ref+'^{commit}'], cwd=path)
+        return path, commit
+
+    def checkout(self, url, ref, path):
+        """Check out `ref` of `url` in `path`; return the commit hash.
+
+        An existing checkout is verified, not changed.
+        """
+        if os.path.exists(path):
+            return verify_checkout(path, ref)
+
+        mirror, commit = self.mirror(url, ref)
+        _git(['clone', '-q', '--shared', '--no-checkout', mirror, path])
+        _git(['remote', 'set-url', 'origin', url], cwd=path)
+        _git(['checkout', '-q', '--detach', commit], cwd=path)
+        return commit
+
+    def checkout_externals(self, root, externals='Externals.cfg', max_workers=8, sandbox=None):
+        """Check out the required externals described in `root`/`externals`,
+        and their own externals, in parallel.
+
+        git externals come from the mirrors; the others (svn, sparse
+        checkouts) are left to manage_externals of the CESM `sandbox`
+        (default `root`).
+        """
+        if sandbox is None:
+            sandbox = root
+
+        config = ConfigParser()
+        config.read(os.path.join(root, externals))
+
+        components, other = [], []
+        for name in config.sections():
+            if name == 'externals_description':
+                continue
+            ext = dict(config.items(name))
+            if ext.get('required', 'True').lower() != 'true':
+                continue
+            if ext.get('protocol') == 'git' and 'sparse' not in ext:
+                components.append((name, ext))
+            else:
+                other.append(name)
+
+        def checkout(component):
+            name, ext = component
+            ref = ext.get('tag') or ext.get('hash') or ext.get('branch')
+            path = os.path.join(root, ext['local_path'])
+            print('%s: %s %s' % (name, ext['repo_url'], ref))
+            self.checkout(ext['repo_url'], ref, path)
+            if ext.get('externals'):
+                self.checkout_externals(path, ext['externals'], max_workers, sandbox)
+
+        pool = ThreadPool(max(1, min(max_workers, len(components))))
+        try:
+            pool.map(checkout, components)
+        finally:
+            pool.close()
+
+        if other:
+            check_call([os.path.join(sandbox, 'manage_externals', 'checkout_externals'),
+                        '-e', externals] + other, cwd=root)
+
+
+def verify_checkout(path, ref):
+    """Check that the sandbox in `path` is at the commit of `ref`; return
+    the commit hash."""
+    head = _git(['rev-parse', 'HEAD'], cwd=path)
+    commit = _git(['rev-parse', '--verify', '-q', ref+'^{commit}'], cwd=path)
+    if head != commit:
+        raise ValueError('%s: HEAD is %s, not %s (%s)' % (path, head, ref, commit))
+    return commit
+
+
+def code_checkout(cesm_repo, coderoot, tag, cache=None, max_workers=8):
+    """Checkout code for CESM
+    If sandbox exists, check that the commit of the tag has been checked-out.
+
+    Otherwise, check out the tag and the externals from the local mirrors
+    in `cache` (a `CodeCache`), updating the mirrors only if they lack the
+    tag.
+    """
+    if cache is None:
+        cache = CodeCache()
 
     if os.path.exists(coderoot):
         print('Check for right tag: '+coderoot)
-        p = Popen('git status', shell=True, cwd=coderoot, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        stdout = stdout.decode('UTF-8')
-        stderr = stderr.decode('UTF-8')
-        print(stdout)
-        print(stderr)
-        if tag not in stdout.split('\n')[0]:
-            raise ValueError('tag does not match')
+        commit = verify_checkout(coderoot, tag)
+        print('%s: %s at %s' % (coderoot, tag, commit))
+        return commit
 
-    else:
-        stat = check_call(['mkdir', '-p', coderoot])
-        if stat != 0: sys.exit(1)
+    check_call(['mkdir', '-p', os.path.dirname(coderoot)])
+    commit = cache.checkout(cesm_repo, tag, coderoot)
+    cache.checkout_externals(coderoot, max_workers=max_workers)
+    return commit
+
+
+_timing_component = re.compile(r'^\s*(\w+) = \w+\s+\d+\s+(\d+)\s+(\d+)\s+x\s+(\d+)')
+_timing_run_time = re.compile(r'^\s*(\w+) Run Time:\s+[\d.]+ seconds\s+([\d.]+) seconds/mday')
+
+
+def read_timing(path):
+    """Read a CESM timing summary (timing/cesm_timing.*).
+
+    Returns
+    -------
+    timing : dict
+      {component: {'rootpe', 'tasks', 'threads', 'seconds_per_mday'}} for
+      each component in the PE table, lower case (cpl, atm, ocn, ...),
+      and 'tot' with the total seconds_per_mday.
+    """
+    timing = {}
+    with open(path) as f:
+        for line in f:
+            match = _timing_component.match(line)
+            if match:
+                comp, rootpe, tasks, threads = match.groups()
+                timing.setdefault(comp.lower(), {}).update(
+                    rootpe=int(rootpe), tasks=int(tasks), threads=int(threads))
+                continue
+            match = _timing_run_time.match(line)
+            if match:
+                comp, seconds = match.groups()
+                timing.setdefault(comp.lower(), {})['seconds_per_mday'] = float(seconds)
+    if 'tot' not in timing:
+        raise ValueError('%s: no run time found' % path)
+    return timing
+
+
+def fit_cost_model(timing_files):
+    """Fit T = a / n + b to the run time T (seconds/mday) of each component
+    on n pes (tasks x threads), from one or more timing summaries.
+
+    With a single pe count, the component is assumed to scale perfectly
+    (b = 0).
+
+    Returns
+    -------
+    model : dict
+      {component: (a, b)} of the components with both a PE table entry and
+      a run time, without 'tot'.
+    """
+    points = {}
+    for path in timing_files:
+        for comp, t in read_timing(path).items():
+            if comp != 'tot' and 'tasks' in t and 'seconds_per_mday' in t:
+                points.setdefault(comp, []).append(
+                    (1. / (t['tasks'] * t['threads']), t.get('seconds_per_mday', 0.)))
+
+    model = {}
+    for comp, xy in points.items():
+        n = len(xy)
+        mx = sum(x for x, y in xy) / n
+        my = sum(y for x, y in xy) / n
+        sxx = sum((x - mx)**2 for x, y in xy)
+        if sxx == 0.:
+            a, b = my / mx, 0.
+        else:
+            a = sum((x - mx) * (y - my) for x, y in xy) / sxx
+            b = my - a * mx
+            if b < 0.:
+                a, b = sum(x * y for x, y in xy) / sum(x * x for x, y in xy), 0.
+            elif a < 0.:
+                a, b = 0., my
+        model[comp] = (a, b)
+    return model
+
+
+def pop_decomp(ntasks, nx=320, ny=384):
+    """Return the xmlchange settings of a cartesian POP decomposition of the
+    nx x ny grid (gx1v7 by default) into one block per task, choosing the
+    factorization with the smallest block perimeter.
+    """
+    best = None
+    for nx_blocks in range(1, ntasks + 1):
+        if ntasks % nx_blocks:
+            continue
+        ny_blocks = ntasks // nx_blocks
+        blckx, blcky = -(-nx // nx_blocks), -(-ny // ny_blocks)
+        # perimeter (halo), then padding
+        score = (blckx + blcky, blckx * nx_blocks * blcky * ny_blocks)
+        if best is None or score < best[0]:
+            best = (score, blckx, blcky, nx_blocks, ny_blocks)
+
+    score, blckx, blcky, nx_blocks, ny_blocks = best
+    return OrderedDict([('POP_BLCKX', blckx),
+                        ('POP_BLCKY', blcky),
+                        ('POP_NX_BLOCKS', nx_blocks),
+                        ('POP_NY_BLOCKS', ny_blocks),
+                        ('POP_MXBLCKS', 1),
+                        ('POP_DECOMPTYPE', 'cartesian'),
+                        ('POP_AUTO_DECOMP', False)])
+
+
+def propose_layout(model, max_tasks, nthrds=1, task_step=36, min_throughput=None):
+    """Propose a PE layout from a `fit_cost_model` model.
+
+    The ocean runs concurrently with the other components, which run one
+    after the other on a shared set of tasks starting at task 0. Task
+    counts are multiples of `task_step` (a node) and each component uses
+    `nthrds` threads. ESP and components not in `model` are left out of
+    the layout, so their settings (e.g. from experiments.yml) are kept.
+
+    Without `min_throughput`, the layout minimises the run time within
+    `max_tasks` tasks; with it, the layout minimises the cost among those
+    with at least `min_throughput` simulated years/day.
+
+    Returns
+    -------
+    layout : OrderedDict
+      xmlchange settings: NTASKS, NTHRDS and ROOTPE of each component and
+      the POP decomposition.
+    prediction : dict
+      'seconds_per_mday', 'sypd' (simulated years/day) and 'cost'
+      (pe-hours/simulated year).
+    """
+    others = sorted(comp for comp in model if comp not in ['ocn', 'esp'])
+
+    def run_time(pes, comps):
+        return sum(model[comp][0] / pes + model[comp][1] for comp in comps)
+
+    best = None
+    for ntasks_other in range(task_step, max_tasks, task_step):
+        t_other = run_time(ntasks_other * nthrds, others)
+        for ntasks_ocn in range(task_step, max_tasks - ntasks_other + 1, task_step):
+            t = max(t_other, run_time(ntasks_ocn * nthrds, ['ocn']))
+            sypd = 86400. / (t * 365.)
+            cost = (ntasks_other + ntasks_ocn) * nthrds * t * 365. / 3600.
+            if min_throughput is None:
+                score = (t, cost)
+            elif sypd >= min_throughput:
+                score = (cost, t)
+            else:
+                continue
+            if best is None or score < best[0]:
+                best = (score, ntasks_other, ntasks_ocn,
+                        dict(seconds_per_mday=t, sypd=sypd, cost=cost))
+
+    if best is None:
+        raise ValueError('no layout within %d tasks reaches %g simulated years/day'
+                         % (max_tasks, min_throughput))
+    score, ntasks_other, ntasks_ocn, prediction = best
 
-        # clone the repo
-        p = Popen('git clone '+cesm_repo+' '+sandbox, shell=True,
-                  cwd=coderoot+'/..', stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        if stdout:
-            print(stdout)
-        if stderr:
-            print(stderr)
-        if p.returncode != 0:
-            raise Exception('git error')
-
-        # check out the right tag
-        p = Popen('git checkout %s'%tag, shell=True, cwd=coderoot)
-        stdout, stderr = p.communicate()
-        if stdout:
-            print(stdout)
-        if stderr:
-            print(stderr)
-        if p.returncode != 0:
-            raise Exception('git error')
-
-        # check out externals
-        p = Popen('./manage_externals/checkout_externals -v', shell=True, cwd=coderoot)
-        stdout, stderr = p.communicate()
-        if stdout:
-            print(stdout)
-        if stderr:
-            print(stderr)
-        if p.returncode != 0:
-            raise Exception('git error')
+    layout = OrderedDict()
+    for comp in others + ['ocn']:
+        layout['NTASKS_'+comp.upper()] = ntasks_ocn if comp == 'ocn' else ntasks_other
+        layout['NTHRDS_'+comp.upper()] = nthrds
+        layout['ROOTPE_'+comp.upper()] = ntasks_other if comp == 'ocn' else 0
+    layout.update(pop_decomp(ntasks_ocn))
+    return layout, prediction
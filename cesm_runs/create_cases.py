@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+"""Create, build and submit the cases defined in an experiment matrix
+(experiments.yml).
+
+Code is checked out once per tag from local git mirrors, cases are
+created and set up concurrently, and cases share or incrementally
+rebuild earlier builds with the same code, settings and SourceMods (see
+`build_cases`).
+
+    ./create_cases.py                 # all experiments
+    ./create_cases.py xtfe xtfe_30x   # a subset
+    ./create_cases.py --timing run/timing/cesm_timing.*   # tuned PE layout
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import argparse
+from collections import OrderedDict
+from copy import deepcopy
+from glob import glob
+from multiprocessing.pool import ThreadPool
+from subprocess import check_call
+
+import yaml
+
+from cesm_case_tools import (defcase, CaseConfig, user_nl_append, code_checkout,
+                             build_settings, build_hash, BuildRegistry, share_build,
+                             clone_build, CodeCache, read_timing, fit_cost_model,
+                             propose_layout)
+
+scriptroot = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_matrix(matrix_file, names=None):
+    """Return the settings of each experiment in `matrix_file`, merged with
+    the defaults, in file order.
+    """
+    with open(matrix_file) as f:
+        matrix = yaml.safe_load(f)
+
+    experiments = matrix['experiments']
+    if not names:
+        names = list(experiments)
+    unknown = [name for name in names if name not in experiments]
+    if unknown:
+        raise ValueError('unknown experiments: %s' % ', '.join(unknown))
+
+    configs = []
+    for name in names:
+        exp = deepcopy(matrix.get('defaults', {}))
+        for key, val in experiments[name].items():
+            if key in ['xmlchange', 'pe_layout']:
+                exp.setdefault(key, {}).update(val)
+            elif key == 'user_nl':
+                for mdl, nml in val.items():
+                    exp.setdefault('user_nl', {}).setdefault(mdl, []).extend(nml)
+            else:
+                exp[key] = val
+        exp['name'] = name
+        exp['coderoot'] = os.path.join(exp['coderoot_parent'], exp['tag'])
+        configs.append(exp)
+    return configs
+
+
+def _case(exp):
+    """Return the `defcase` for an experiment."""
+    caserootroot = os.path.join('/glade/work', os.environ['USER'], 'cesm_cases')
+    if exp['project_name']:
+        caserootroot = os.path.join(caserootroot, exp['project_name'])
+
+    return defcase(compref=exp['compref'], compset=exp['compset'], res=exp['res'],
+                   note=exp['note'], ens=exp['ens'], croot=caserootroot)
+
+
+def create_case(exp, clobber=False):
+    """Create and set up the case for one experiment; returns its `defcase`."""
+    case = _case(exp)
+    caseroot = case.path['root']
+
+    case_desc_file = os.path.join(scriptroot, 'case-description', case.name+'.description')
+    existing = [p for p in list(case.path.values()) + [case_desc_file] if os.path.exists(p)]
+    if existing and not clobber:
+        raise ValueError('%s: %s exist; use --clobber to replace'
+                         % (exp['name'], ', '.join(existing)))
+
+    with open(case_desc_file, 'w') as f:
+        f.write(exp['description'])
+
+    for key, pth in case.path.items():
+        check_call(['rm', '-fr', pth])
+
+    check_call([os.path.join(exp['coderoot'], 'cime/scripts', 'create_newcase'),
+                '--res', exp['res'],
+                '--mach', exp['mach'],
+                '--compset', exp['compset'],
+                '--case', caseroot,
+                '--project', exp['project_code'],
+                '--run-unsupported'])
+
+    with CaseConfig(caseroot) as config:
+        if exp['run_refcase']:
+            config.change({'RUN_TYPE': 'hybrid',
+                           'RUN_STARTDATE': exp['run_refdate'],
+                           'RUN_REFCASE': exp['run_refcase'],
+                           'RUN_REFDATE': exp['run_refdate']})
+        else:
+            config.change({'RUN_TYPE': 'startup'})
+
+        config.change({'JOB_QUEUE': exp['queue'],
+                       'JOB_WALLCLOCK_TIME': exp['walltime']}, subgroup='case.run')
+        config.change(exp.get('xmlchange', {}))
+        config.change(exp.get('pe_layout', {}))
+
+    if exp['run_refcase']:
+        rundir = os.path.join(case.path['exe'], 'run')
+        refcase_root = os.path.join(exp['refcase_archive'], exp['run_refcase'], 'rest',
+                                    exp['run_refdate']+'-00000')
+        check_call(['mkdir', '-p', rundir])
+        check_call(['cp', '-v'] + glob(refcase_root+'/*') + [rundir])
+
+    if exp['source_mod_dir']:
+        for cmp in ['pop', 'datm', 'drv']:
+            frm = glob(os.path.join(scriptroot, exp['source_mod_dir'], 'src.'+cmp, '*'))
+            if frm:
+                check_call(['cp', '-v'] + frm + [os.path.join(caseroot, 'SourceMods', 'src.'+cmp)])
+
+    user_nl_append(exp.get('user_nl', {}), caseroot=caseroot)
+
+    check_call(['./case.setup'], cwd=caseroot)
+    check_call(['./preview_namelists'], cwd=caseroot)
+
+    with CaseConfig(caseroot) as config:
+        config.change({'STOP_N': exp['stop_n'],
+                       'STOP_OPTION': exp['stop_option'],
+                       'RESUBMIT': exp['resubmit']})
+    return case
+
+
+def build_cases(exps, cases, pool, registry=None):
+    """Build the cases, one build per set of `build_settings`.
+
+    A case whose settings match a build in the registry uses that build;
+    one that differs from a registered build only in a Fortran SourceMod
+    starts from a copy of it and recompiles that file. Otherwise the case
+    is built from scratch. Builds go to the registry's directory for their
+    settings, not to a case directory, so that they survive --clobber of
+    the case that made them. Builds with the same settings but for the
+    SourceMods are done one after the other, so that all but the first can
+    be incremental.
+    """
+    if registry is None:
+        registry = BuildRegistry()
+
+    groups = OrderedDict()
+    for exp, case in zip(exps, cases):
+        settings = build_settings(case.path['root'], exp['tag'])
+        groups.setdefault(build_hash(settings), []).append((exp, case, settings))
+
+    def build(group):
+        exp, case, settings = group[0]
+        caseroot = case.path['root']
+
+        found = registry.find(settings)
+        if found:
+            exeroot = found['exeroot']
+            print('%s: using the build of %s' % (case.name, found['case']))
+            share_build(caseroot, exeroot)
+        else:
+            exeroot = registry.build_dir(settings)
+            with CaseConfig(caseroot) as config:
+                config.change({'EXEROOT': exeroot})
+
+            nearest, changed = registry.nearest(settings)
+            if nearest:
+                print('%s: recompiling %s in a copy of the build of %s'
+                      % (case.name, ', '.join(changed), nearest['case']))
+                clone_build(caseroot, nearest['exeroot'], changed)
+            check_call(['qcmd', '-A', exp['project_code'], '--', './case.build'], cwd=caseroot)
+            registry.register(settings, caseroot)
+
+        for exp, other, settings in group[1:]:
+            print('%s: using the build of %s' % (other.name, case.name))
+            share_build(other.path['root'], exeroot)
+
+    pending = list(groups.values())
+    while pending:
+        now, later, bases = [], [], set()
+        for group in pending:
+            settings = group[0][2]
+            base = build_hash(settings, sourcemods=False)
+            if base in bases and not registry.nearest(settings)[0]:
+                later.append(group)
+            else:
+                now.append(group)
+                bases.add(base)
+        pool.map(build, now)
+        pending = later
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('experiments', nargs='*', help='experiments to create (default all)')
+    parser.add_argument('--matrix', default=os.path.join(scriptroot, 'experiments.yml'))
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--clobber', action='store_true',
+                        help='remove existing case, run and archive directories')
+    parser.add_argument('--no-build', action='store_true')
+    parser.add_argument('--no-submit', action='store_true')
+    parser.add_argument('--timing', nargs='+', metavar='FILE',
+                        help='timing/cesm_timing.* files of earlier runs; replace the PE '
+                        'layout with one proposed from them')
+    parser.add_argument('--max-tasks', type=int,
+                        help='tasks available to the proposed layout (default the most '
+                        'used in the timing files)')
+    parser.add_argument('--nthrds', type=int,
+                        help='threads per task in the proposed layout (default the most '
+                        'used in the timing files)')
+    parser.add_argument('--min-throughput', type=float, metavar='SYPD',
+                        help='minimise cost at this throughput instead of run time')
+    args = parser.parse_args(argv)
+
+    exps = load_matrix(args.matrix, args.experiments)
+
+    if args.timing:
+        timing = [[t for t in read_timing(f).values() if 'tasks' in t] for f in args.timing]
+        max_tasks = args.max_tasks
+        if max_tasks is None:
+            max_tasks = max(max(t['rootpe'] + t['tasks'] for t in comps) for comps in timing)
+        nthrds = args.nthrds
+        if nthrds is None:
+            nthrds = max(max(t['threads'] for t in comps) for comps in timing)
+        layout, prediction = propose_layout(fit_cost_model(args.timing), max_tasks,
+                                            nthrds=nthrds,
+                                            min_throughput=args.min_throughput)
+        print('proposed PE layout: %.1f simulated years/day, %.0f pe-hours/simulated year'
+              % (prediction['sypd'], prediction['cost']))
+        # settings the proposal leaves out keep their experiments.yml values
+        for exp in exps:
+            exp.setdefault('pe_layout', {}).update(layout)
+    pool = ThreadPool(args.max_workers)
+
+    # one checkout per tag, from local mirrors shared by all tags
+    cache = CodeCache()
+    checkouts = dict((exp['tag'], exp) for exp in exps)
+    pool.map(lambda exp: code_checkout(exp['cesm_repo'], exp['coderoot'], exp['tag'], cache),
+             list(checkouts.values()))
+
+    cases = pool.map(lambda exp: create_case(exp, args.clobber), exps)
+
+    if args.no_build:
+        return
+    build_cases(exps, cases, pool)
+
+    if not args.no_submit:
+        for case in cases:
+            check_call(['./case.submit'], cwd=case.path['root'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
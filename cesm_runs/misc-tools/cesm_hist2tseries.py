@@ -11,13 +11,15 @@ import click
 import yaml
 import tempfile
 import logging
+from contextlib import nullcontext
 
 import cftime
-import xarray as xr
 import numpy as np
 
 import globus
-from workflow import task_manager as tm
+import hist_index
+import tseries_splitter
+import task_pool
 
 logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.INFO)
@@ -32,10 +34,25 @@ GLOBUS_CAMPAIGN_PATH = '/gpfs/csfs1/cesm/development/bgcwg/projects/xtFe/cases'
 USER = os.environ['USER']
 ARCHIVE_ROOT = f'/glade/scratch/{USER}/archive'
 
-tm.ACCOUNT = 'NCGD0011'
-tm.MAXJOBS = 100
+ACCOUNT = 'NCGD0011'
+MAXJOBS = 100
+
+def get_task_manager(executor='task_manager', max_workers=None, max_memory=None):
+    """Return the backend used to run conversion tasks: the batch scheduler
+       via `workflow.task_manager` or a local process pool.
+    """
+    if executor == 'process':
+        return task_pool.TaskPool(max_workers=max_workers, max_memory=max_memory)
+
+    elif executor == 'task_manager':
+        from workflow import task_manager as tm
+        tm.ACCOUNT = ACCOUNT
+        tm.MAXJOBS = MAXJOBS
+        return tm
+
+    else:
+        raise ValueError(f'unknown executor: {executor}')
 
-xr_open = dict(decode_times=False, decode_coords=False)
 
 def get_year_filename(file):
     """Get the year from the datestr part of a file."""
@@ -46,34 +63,40 @@ class file_date(object):
     """Class with attributes for the start, stop, and middle of a file's time
        axis.
     """
-    def __init__(self, file):
-        with xr.open_dataset(file, **xr_open) as ds:
-            time_units = ds.time.units
-            calendar = ds.time.calendar
-            tb = ds.time.bounds
-            tb_dim = ds[tb].dims[-1]
+    def __init__(self, file, index=None):
+        if index is not None:
+            record = index.get(file)
+        else:
+            record = hist_index.scan_file(file)
 
-            t0 = ds[tb].isel(**{'time': 0, tb_dim: 0})
-            tf = ds[tb].isel(**{'time': -1, tb_dim: -1})
+        time_units = record['time_units']
+        calendar = record['calendar']
 
-            self.date = cftime.num2date(np.mean([t0, tf]), units=time_units,
-                                        calendar=calendar)
-            self.year = self.date.year
-            self.month = self.date.month
-            self.day = self.date.day
+        t0 = record['tb_first'][0]
+        tf = record['tb_last'][-1]
 
-            time_mid_point = cftime.num2date(ds[tb].mean(dim=tb_dim),
-                                             units=time_units, calendar=calendar)
+        self.date = cftime.num2date(np.mean([t0, tf]), units=time_units,
+                                    calendar=calendar)
+        self.year = self.date.year
+        self.month = self.date.month
+        self.day = self.date.day
 
-            self.t0 = time_mid_point[0]
-            self.tf = time_mid_point[-1]
+        time_mid_point = cftime.num2date([np.mean(record['tb_first']),
+                                          np.mean(record['tb_last'])],
+                                         units=time_units, calendar=calendar)
 
+        self.t0 = time_mid_point[0]
+        self.tf = time_mid_point[-1]
 
-def get_date_string(files, freq):
+        # end of the last time bound
+        self.end = cftime.num2date(tf, units=time_units, calendar=calendar)
+
+
+def get_date_string(files, freq, index=None):
     """return a date string for timeseries files"""
 
-    date_start = file_date(files[0])
-    date_end = file_date(files[-1])
+    date_start = file_date(files[0], index)
+    date_end = file_date(files[-1], index)
 
     year = [date_start.t0.year, date_end.tf.year]
     month = [date_start.t0.month, date_end.tf.month]
@@ -94,18 +117,79 @@ def get_date_string(files, freq):
         raise ValueError(f'freq: {freq} not implemented')
 
 
-def get_vars(files):
+def get_vars(files, index=None):
     """get lists of non-time-varying variables and time varying variables"""
 
-    with xr.open_dataset(files[0], **xr_open) as ds:
-        static_vars = [v for v, da in ds.variables.items() if 'time' not in da.dims]
-        static_vars = static_vars+['time', ds.time.attrs['bounds']]
+    if index is not None:
+        record = index.get(files[0])
+    else:
+        record = hist_index.scan_file(files[0])
 
-        time_vars = [v for v, da in ds.variables.items() if 'time' in da.dims and
-                     v not in static_vars]
+    static_vars = [v for v, dims in record['variables'] if 'time' not in dims]
+    static_vars = static_vars+['time', record['time_bounds']]
+
+    time_vars = [v for v, dims in record['variables'] if 'time' in dims and
+                 v not in static_vars]
     return static_vars, time_vars
 
 
+def get_tseries_files(dout, case, stream, v):
+    """Return the sorted list of existing timeseries files for variable `v`."""
+    prefix = f'{case}.{stream}.{v}.'
+    return sorted(f for f in glob(f'{dout}/{prefix}*.nc')
+                  if re.fullmatch(r'\d+-\d+', os.path.basename(f)[len(prefix):-3]))
+
+
+def get_incremental_groups(dout, case, stream, time_vars, files, files_year,
+                           chunk_years, index=None):
+    """Group history files that end after the last time bound of the existing
+       timeseries of each variable into chunks of `chunk_years` years.
+
+    The first chunk is appended to the last existing timeseries file if that
+    file spans fewer than `chunk_years` years.
+
+    Returns
+    -------
+    groups : list
+      List of (files, append_date, vars) tuples, where `append_date` is the
+      date string of the timeseries file to append to or None.
+    """
+    files_end = [file_date(f, index).end for f in files]
+
+    groups = {}
+    for v in time_vars:
+        tseries_files = get_tseries_files(dout, case, stream, v)
+        append_date = None
+        new = list(zip(files, files_year))
+        if tseries_files:
+            date_string = tseries_files[-1].split('.')[-2]
+            y0 = int(date_string[:4])
+            # timeseries files are read directly; `index` is for history files
+            tseries_date = file_date(tseries_files[-1])
+            new = [(f, y) for f, y, end in zip(files, files_year, files_end)
+                   if end > tseries_date.end]
+            if tseries_date.tf.year - y0 + 1 < chunk_years:
+                append_date = date_string
+        if not new:
+            continue
+
+        # a timeseries that ends partway through a year is continued from
+        # the remaining months of that year
+        chunk_start = y0 if append_date is not None else new[0][1]
+
+        chunks = {}
+        for f, y in new:
+            chunks.setdefault((y - chunk_start) // chunk_years, []).append(f)
+
+        for k, files_chunk in chunks.items():
+            key = (tuple(files_chunk), append_date if k == 0 else None)
+            groups.setdefault(key, []).append(v)
+
+    return sorted([(list(files_chunk), append_date, vars)
+                   for (files_chunk, append_date), vars in groups.items()],
+                  key=lambda g: g[0][0])
+
+
 @click.command()
 @click.argument('case')
 @click.option('--components', default='ocn')
@@ -116,10 +200,24 @@ def get_vars(files):
 @click.option('--year-groups', default=None)
 @click.option('--demo', default=False, is_flag=True)
 @click.option('--clobber', default=False, is_flag=True)
+@click.option('--engine', default='splitter', type=click.Choice(['splitter', 'ncrcat']))
+@click.option('--executor', default='task_manager',
+              type=click.Choice(['task_manager', 'process']))
+@click.option('--max-workers', default=None, type=int)
+@click.option('--max-memory', default=None)
+@click.option('--index/--no-index', default=True)
+@click.option('--incremental', default=False, is_flag=True)
+@click.option('--chunk-years', default=62)
+@click.option('--zarr', default=False, is_flag=True)
+@click.option('--transfer-max-files', default=globus.MAX_BATCH_FILES)
+@click.option('--transfer-max-gb', default=globus.MAX_BATCH_BYTES / 1024**3)
 
 def main(case, components=['ocn', 'ice'], archive_root=ARCHIVE_ROOT, only_streams=[],
          campaign_transfer=False, campaign_path=None, year_groups=None,
-         demo=False, clobber=False):
+         demo=False, clobber=False, engine='splitter', executor='task_manager',
+         max_workers=None, max_memory=None, index=True, incremental=False,
+         chunk_years=62, zarr=False, transfer_max_files=globus.MAX_BATCH_FILES,
+         transfer_max_gb=globus.MAX_BATCH_BYTES / 1024**3):
 
     droot = os.path.join(archive_root, case)
     if isinstance(components, str):
@@ -128,6 +226,13 @@ def main(case, components=['ocn', 'ice'], archive_root=ARCHIVE_ROOT, only_stream
     if campaign_transfer and campaign_path is None:
         raise ValueError('campaign path required')
 
+    if incremental:
+        if engine != 'splitter':
+            raise ValueError('incremental mode requires the splitter engine')
+        if campaign_transfer:
+            raise ValueError('incremental mode appends to local timeseries files; '
+                             'it cannot be combined with campaign transfer')
+
     if isinstance(year_groups, str):
         year_groups = year_groups.split(',')
         year_groups = [tuple(int(i) for i in ygi.split(':')) for ygi in year_groups]
@@ -138,114 +243,230 @@ def main(case, components=['ocn', 'ice'], archive_root=ARCHIVE_ROOT, only_stream
     if isinstance(only_streams, str):
         only_streams = only_streams.split(',')
 
-    logger.info('constructing time-series of the following year groups:')
-    logger.info(year_groups)
+    tm = get_task_manager(executor, max_workers=max_workers, max_memory=max_memory)
+
+    if incremental:
+        logger.info(f'extending time-series in chunks of {chunk_years} years')
+    else:
+        logger.info('constructing time-series of the following year groups:')
+        logger.info(year_groups)
     print()
 
     with open(f'{script_path}/cesm_streams.yml') as f:
         streams = yaml.safe_load(f)
 
-
-    for component in components:
-        print('='*80)
-        logger.info(f'working on component: {component}')
-        print('='*80)
-        for stream, stream_info in streams[component].items():
-
-            if only_streams:
-                if stream not in only_streams:
+    # timeseries files are queued for transfer as soon as the task writing
+    # them succeeds; sources are removed once their batch has succeeded
+    batcher = None
+    if campaign_transfer and not demo:
+        batcher = globus.TransferBatcher('glade', 'campaign',
+                                         max_files=transfer_max_files,
+                                         max_bytes=int(transfer_max_gb * 1024**3))
+    deferred = []
+
+    def submit(cmds, transfers, **kwargs):
+        """Submit a conversion task writing the (src_path, dst_path) files in
+           `transfers`, queueing them for transfer once it succeeds.
+        """
+        if batcher is None or not transfers:
+            return tm.submit(cmds, **kwargs)
+
+        if not isinstance(tm, task_pool.TaskPool):
+            # no completion callbacks: queue after tm.wait() the files
+            # that exist, as they are moved into place only on success
+            deferred.extend(transfers)
+            return tm.submit(cmds, **kwargs)
+
+        def callback(result):
+            if result['returncode'] != 0:
+                logger.warning(f'task {result["task_id"]} failed: not transferring '
+                               f'{len(transfers)} files')
+                return
+            for src_path, dst_path in transfers:
+                batcher.add(src_path, dst_path)
+
+        return tm.submit(cmds, callback=callback, **kwargs)
+
+
+    # metadata of history files, kept next to the archive across runs
+    index_file = os.path.join(droot, hist_index.INDEX_FILENAME)
+    with (hist_index.HistoryIndex(index_file) if index else nullcontext()) as index:
+        for component in components:
+            print('='*80)
+            logger.info(f'working on component: {component}')
+            print('='*80)
+            for stream, stream_info in streams[component].items():
+
+                if only_streams:
+                    if stream not in only_streams:
+                        continue
+
+                print('-'*80)
+                logger.info(f'working on stream: {stream}')
+                print('-'*80)
+
+                dateglob = stream_info['dateglob']
+                dateregex = stream_info['dateregex']
+                freq = stream_info['freq']
+
+                dout = f'{droot}/{component}/proc/tseries/{freq}'
+                if not os.path.exists(dout):
+                    os.makedirs(dout, exist_ok=True)
+
+                # set target destination on globus
+                globus_file_list = []
+                if campaign_transfer:
+                    campaign_dout = f'{campaign_path}/{case}/{component}/proc/tseries/{freq}'
+                    globus.makedirs('campaign', campaign_dout)
+                    globus_file_list = globus.listdir('campaign', campaign_dout)
+                    logger.info(f'found {len(globus_file_list)} files on campaign.')
+
+                # get input files
+                files = sorted(glob(f'{droot}/{component}/hist/{case}.{stream}.{dateglob}.nc'))
+                if len(files) == 0:
+                    logger.warning(f'no files: component={component}, stream={stream}')
                     continue
-
-            print('-'*80)
-            logger.info(f'working on stream: {stream}')
-            print('-'*80)
-
-            dateglob = stream_info['dateglob']
-            dateregex = stream_info['dateregex']
-            freq = stream_info['freq']
-
-            dout = f'{droot}/{component}/proc/tseries/{freq}'
-            if not os.path.exists(dout):
-                os.makedirs(dout, exist_ok=True)
-
-            # set target destination on globus
-            globus_file_list = []
-            if campaign_transfer:
-                campaign_dout = f'{campaign_path}/{case}/{component}/proc/tseries/{freq}'
-                globus.makedirs('campaign', campaign_dout)
-                globus_file_list = globus.listdir('campaign', campaign_dout)
-                logger.info(f'found {len(globus_file_list)} files on campaign.')
-
-            # get input files
-            files = sorted(glob(f'{droot}/{component}/hist/{case}.{stream}.{dateglob}.nc'))
-            if len(files) == 0:
-                logger.warning(f'no files: component={component}, stream={stream}')
-                continue
-
-            # get file dates
-            files_year = [get_year_filename(f) for f in files]
-
-            # get variable lists
-            static_vars, time_vars = get_vars(files)
-
-            # make a report
-            logger.info(f'found {len(files)} history files')
-            logger.info(f'history file years: {min(files_year)}-{max(files_year)}')
-            logger.info(f'found {len(time_vars)} variables to process')
-            logger.info(f'expecting to generate {len(time_vars) * len(year_groups)} timeseries files')
-
-            for y0, yf in year_groups:
-                logger.info(f'working on year group {y0}-{yf}')
-
-                files_group_i = [f for f, y in zip(files, files_year)
-                                 if (y0 <= y) and (y <= yf)]
-
-                fid, tmpfile = tempfile.mkstemp(suffix='.filelist', prefix='tmpfile',
-                                                dir=os.environ['TMPDIR'])
-
-                with open(tmpfile,'w') as fid:
-                    for i, f in enumerate(files_group_i):
-                        fid.write('%s\n'%f)
-
-                # get the date string
-                date_cat = get_date_string(files_group_i, freq)
-
-                for i, v in enumerate(time_vars):
-                    file_cat_basename = '.'.join([case, stream, v, date_cat, 'nc'])
-                    file_cat = os.path.join(dout, file_cat_basename)
-
-                    if not clobber:
-                        if file_cat_basename in globus_file_list:
-                            print(f'on campaign: {file_cat_basename}...skipping')
-                            continue
-                        if os.path.exists(file_cat):
-                            print(f'exists: {file_cat_basename}...skipping')
-                            continue
-
-                    logger.info(f'creating {file_cat}')
-                    vars = ','.join(static_vars+[v])
-                    cat_cmd = [f'cat {tmpfile} | ncrcat -O -h -v {vars} {file_cat}']
-                    compress_cmd = [f'ncks -O -4 -L 1 {file_cat} {file_cat}']
-
-                    if not demo:
-                        if campaign_transfer:
-                            xfr_cmd = [f'{script_path}/globus.py',
-                                       '--src-ep=glade --dst-ep=campaign',
-                                       '--retry=3',
-                                       f'--src-paths={file_cat}',
-                                       f'--dst-paths={campaign_dout}/{file_cat_basename}']
-
-                            cleanup_cmd = [f'if [ $? -eq 0 ]; then rm -f {file_cat}; else exit 1; fi']
+                if index is not None:
+                    index.update(files)
+
+                # get file dates
+                files_year = [get_year_filename(f) for f in files]
+
+                # get variable lists
+                static_vars, time_vars = get_vars(files, index)
+
+                # make a report
+                logger.info(f'found {len(files)} history files')
+                logger.info(f'history file years: {min(files_year)}-{max(files_year)}')
+                logger.info(f'found {len(time_vars)} variables to process')
+
+                if incremental:
+                    groups = get_incremental_groups(dout, case, stream, time_vars,
+                                                    files, files_year, chunk_years, index)
+                else:
+                    logger.info(f'expecting to generate {len(time_vars) * len(year_groups)} timeseries files')
+                    groups = [([f for f, y in zip(files, files_year) if (y0 <= y) and (y <= yf)],
+                               None, time_vars) for y0, yf in year_groups]
+
+                for files_group_i, append_date, group_vars in groups:
+                    if not files_group_i:
+                        continue
+
+                    logger.info(f'working on years {get_year_filename(files_group_i[0])}-'
+                                f'{get_year_filename(files_group_i[-1])}')
+
+                    fid, tmpfile = tempfile.mkstemp(suffix='.filelist', prefix='tmpfile',
+                                                    dir=os.environ['TMPDIR'])
+
+                    with open(tmpfile,'w') as fid:
+                        for i, f in enumerate(files_group_i):
+                            fid.write('%s\n'%f)
+
+                    # get the date string
+                    date_cat = get_date_string(files_group_i, freq, index)
+                    if append_date is not None:
+                        date_cat = '-'.join([append_date.split('-')[0], date_cat.split('-')[-1]])
+                        logger.info(f'appending to {append_date} --> {date_cat}')
+
+                    vars_todo = []
+                    for i, v in enumerate(group_vars):
+                        file_cat_basename = tseries_splitter.tseries_filename(case, stream, v, date_cat)
+                        file_cat = os.path.join(dout, file_cat_basename)
+
+                        if not clobber:
+                            if file_cat_basename in globus_file_list:
+                                print(f'on campaign: {file_cat_basename}...skipping')
+                                continue
+                            if os.path.exists(file_cat):
+                                print(f'exists: {file_cat_basename}...skipping')
+                                continue
+                        vars_todo.append(v)
+
+                    if engine == 'splitter' and vars_todo:
+                        # one pass through the history files for all variables
+                        files_cat = [os.path.join(dout, tseries_splitter.tseries_filename(
+                            case, stream, v, date_cat)) for v in vars_todo]
+                        logger.info(f'creating {len(files_cat)} files in {dout}')
+
+                        split_cmd = [f'{script_path}/tseries_splitter.py',
+                                     f'--case={case}', f'--stream={stream}',
+                                     f'--date-string={date_cat}', f'--dout={dout}',
+                                     f'--static-vars={",".join(static_vars)}',
+                                     f'--time-vars={",".join(vars_todo)}',
+                                     tmpfile]
+                        if append_date is not None:
+                            # appended records take on the file's existing compression
+                            split_cmd.insert(-1, f'--append-date-string={append_date}')
+                            compress_cmd = []
+                        elif 'encoding' in stream_info:
+                            # compressed as written; no uncompressed intermediate
+                            split_cmd.insert(-1, f'--component={component}')
+                            compress_cmd = []
                         else:
-                            xfr_cmd = []
-                            cleanup_cmd = []
+                            compress_cmd = [' && '.join([f'ncks -O -4 -L 1 {f} {f}'
+                                                         for f in files_cat])]
 
-                        jid = tm.submit([cat_cmd, compress_cmd, xfr_cmd, cleanup_cmd],
+                        if not demo:
+                            transfers = []
+                            if campaign_transfer:
+                                transfers = [(f, f'{campaign_dout}/{os.path.basename(f)}')
+                                             for f in files_cat]
+
+                            jid = submit([split_cmd, compress_cmd], transfers,
                                          modules=['nco'], memory='100GB')
 
-                print()
+                    elif engine == 'ncrcat':
+                        for v in vars_todo:
+                            file_cat_basename = tseries_splitter.tseries_filename(case, stream, v, date_cat)
+                            file_cat = os.path.join(dout, file_cat_basename)
+
+                            logger.info(f'creating {file_cat}')
+                            vars = ','.join(static_vars+[v])
+                            # written to {file_cat}.tmp and moved into place once complete
+                            cat_cmd = [f'cat {tmpfile} | ncrcat -O -h -v {vars} {file_cat}.tmp']
+                            compress_cmd = [f'ncks -O -4 -L 1 {file_cat}.tmp {file_cat}.tmp']
+                            mv_cmd = [f'mv {file_cat}.tmp {file_cat}']
+
+                            if not demo:
+                                transfers = []
+                                if campaign_transfer:
+                                    transfers = [(file_cat, f'{campaign_dout}/{file_cat_basename}')]
+
+                                jid = submit([cat_cmd, compress_cmd, mv_cmd], transfers,
+                                             modules=['nco'], memory='100GB')
+
+                    print()
+
+                if zarr and not demo:
+                    # one store per stream, extended with any new history files
+                    fid, tmpfile = tempfile.mkstemp(suffix='.filelist', prefix='tmpfile',
+                                                    dir=os.environ['TMPDIR'])
+                    with open(tmpfile, 'w') as fid:
+                        for f in files:
+                            fid.write('%s\n'%f)
+
+                    logger.info(f'writing {tseries_splitter.zarr_storename(case, stream)}')
+                    zarr_cmd = [f'{script_path}/tseries_splitter.py', '--zarr',
+                                f'--case={case}', f'--stream={stream}', f'--dout={dout}',
+                                f'--component={component}',
+                                f'--static-vars={",".join(static_vars)}',
+                                f'--time-vars={",".join(time_vars)}',
+                                tmpfile]
+                    if index is not None:
+                        zarr_cmd.insert(-1, f'--index={index.db_path}')
+                    jid = tm.submit([zarr_cmd], memory='100GB')
+
+        tm.wait()
+
+    if batcher is not None:
+        for src_path, dst_path in deferred:
+            if not os.path.exists(src_path):
+                logger.warning(f'missing: {src_path}...not transferred')
+                continue
+            batcher.add(src_path, dst_path)
 
-    tm.wait()
+        if not batcher.close():
+            logger.warning(f'{len(batcher.failed)} files failed to transfer')
 
 if __name__ == '__main__':
     main()
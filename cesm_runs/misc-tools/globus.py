@@ -1,9 +1,11 @@
 #! /usr/bin/env python
 import os
 import sys
+import asyncio
 from subprocess import Popen, PIPE
 import tempfile
-from time import sleep
+import threading
+from time import sleep, time
 import click
 
 import yaml
@@ -28,6 +30,17 @@ package_dir = os.path.dirname(os.path.realpath(__file__))
 with open(f'{package_dir}/globus-endpoints.yaml', 'r') as fid:
     endpoints = yaml.safe_load(fid)
 
+# default thresholds at which a `TransferBatcher` submits a batch
+MAX_BATCH_FILES = 1000
+MAX_BATCH_BYTES = 1024**4
+
+# seconds for which an endpoint activation check is reused
+ACTIVATION_TTL = 600
+
+# bounds on the polling interval (seconds) of a `TransferMonitor`
+POLL_MIN = 2
+POLL_MAX = 60
+
 
 def get_endpoint_uuid(endpoint):
     """Get the endpoint UUID."""
@@ -77,6 +90,135 @@ def isactivated(endpoint):
         raise ValueError('isactivated: unknown return code')
 
 
+def _ls(endpoint_uuid, path, filter=None):
+    """Return the names of the entries in `path`, or None if the listing
+       fails (e.g., `path` does not exist).
+    """
+    cmd = ['globus', 'ls', '--format', 'json']
+    if filter is not None:
+        cmd += ['--filter', filter]
+
+    cmd += [f'{endpoint_uuid}:{path}']
+
+    p = Popen(' '.join(cmd), shell=True, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        return None
+
+    data = json.loads(stdout.decode('UTF-8'))
+
+    return [d['name'] for d in data['DATA']]
+
+
+class EndpointSession(object):
+    """Cached view of an endpoint's activation state and directory tree.
+
+    Activation is checked at most once every `ttl` seconds; directory
+    listings are memoized and updated by `mkdir`.
+
+    Parameters
+    ----------
+    endpoint : str
+      Endpoint name (must be in known endpoints).
+    ttl : float, optional
+      Seconds for which a successful activation check is reused.
+    """
+
+    def __init__(self, endpoint, ttl=ACTIVATION_TTL):
+        self.endpoint = endpoint
+        self.endpoint_uuid = get_endpoint_uuid(endpoint)
+        self.ttl = ttl
+        self._activated_at = None
+        self._listings = {}
+
+    def isactivated(self):
+        """Check if the endpoint is activated."""
+        now = time()
+        if self._activated_at is not None and now - self._activated_at < self.ttl:
+            return True
+
+        if isactivated(self.endpoint):
+            self._activated_at = now
+            return True
+
+        self._activated_at = None
+        return False
+
+    def _check_activated(self):
+        if not self.isactivated():
+            raise ValueError('endpoint is not activated')
+
+    def _listing(self, path):
+        """Return the memoized listing of `path`; None if it does not exist."""
+        path = os.path.normpath(path)
+        if path not in self._listings:
+            self._listings[path] = _ls(self.endpoint_uuid, path)
+        return self._listings[path]
+
+    def invalidate(self, path=None):
+        """Drop the cached listing of `path`, or all listings."""
+        if path is None:
+            self._listings = {}
+        else:
+            self._listings.pop(os.path.normpath(path), None)
+
+    def listdir(self, path, filter=None):
+        """Return a sorted list of the entries in `path` (see `listdir`)."""
+        self._check_activated()
+        if filter is not None:
+            listing = _ls(self.endpoint_uuid, path, filter)
+        else:
+            listing = self._listing(path)
+        return sorted(listing or [])
+
+    def exists(self, path):
+        """Return `True` if `path` is an existing directory."""
+        self._check_activated()
+        return self._listing(path) is not None
+
+    def mkdir(self, path):
+        """Make directory."""
+        self._check_activated()
+
+        cmd = ['globus', 'mkdir', f'{self.endpoint_uuid}:{path}']
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise OSError('mkdir failed')
+
+        path = os.path.normpath(path)
+        parent = self._listings.get(os.path.dirname(path))
+        if parent is not None and os.path.basename(path) not in parent:
+            parent.append(os.path.basename(path))
+        self._listings[path] = []
+
+    def makedirs(self, path):
+        """Make `path` and any missing parents, starting from the deepest
+           existing ancestor.
+        """
+        self._check_activated()
+
+        missing = []
+        path = os.path.normpath(path)
+        while path not in ['/', ''] and self._listing(path) is None:
+            missing.append(path)
+            path = os.path.dirname(path)
+
+        for path in reversed(missing):
+            logger.info(f'mkdir: {path}')
+            self.mkdir(path)
+
+
+_sessions = {}
+
+
+def get_session(endpoint):
+    """Return the shared `EndpointSession` for a named endpoint."""
+    if endpoint not in _sessions:
+        _sessions[endpoint] = EndpointSession(endpoint)
+    return _sessions[endpoint]
+
+
 def listdir(endpoint, path, filter=None):
     """Return a list containing the names of the entries in the
        directory given by path.
@@ -107,39 +249,12 @@ def listdir(endpoint, path, filter=None):
       A sorted list containing names of entries in the directory.
 
     """
-    if not isactivated(endpoint):
-        raise ValueError('endpoint is not activated')
-
-    endpoint_uuid = get_endpoint_uuid(endpoint)
-
-    cmd = ['globus', 'ls', '--format', 'json']
-    if filter is not None:
-        cmd += ['--filter', filter]
-
-    cmd += [f'{endpoint_uuid}:{path}']
-
-    p = Popen(' '.join(cmd), shell=True, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        return []
-
-    data = json.loads(stdout.decode('UTF-8'))
-
-    return sorted([d['name'] for d in data['DATA']])
+    return get_session(endpoint).listdir(path, filter)
 
 
 def mkdir(endpoint, path):
     """Make directory."""
-    if not isactivated(endpoint):
-        raise ValueError('endpoint is not activated')
-
-    endpoint_uuid = get_endpoint_uuid(endpoint)
-
-    cmd = ['globus', 'mkdir', f'{endpoint_uuid}:{path}']
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        raise OSError('mkdir failed')
+    get_session(endpoint).mkdir(path)
 
 
 def makedirs(endpoint, path):
@@ -153,16 +268,7 @@ def makedirs(endpoint, path):
       Endpoint name (must be in known endpoints).
 
     """
-
-    endpoint_uuid = get_endpoint_uuid(endpoint)
-
-    pathpart = os.path.normpath(path).split('/')
-    if path[0] == '/':
-        pathpart[0] = '/'
-    for i in range(1, len(pathpart)):
-        if pathpart[i] not in listdir(endpoint, os.path.join(*pathpart[0:i])):
-            logger.info(f'mkdir: {os.path.join(*pathpart[0:i+1])}')
-            mkdir(endpoint, os.path.join(*pathpart[0:i + 1]))
+    get_session(endpoint).makedirs(path)
 
 
 def transfer_async(src, dst, batch_file=None):
@@ -252,14 +358,113 @@ def wait_tasklist(N=80):
         sleep(10)
 
 
+class TransferMonitor(object):
+    """Track many globus tasks from a single process.
+
+    Each polling tick issues one `globus task list` query for all tracked
+    tasks. The interval starts at `poll_min` seconds, grows by `backoff`
+    on every tick without a completion up to `poll_max`, and resets when a
+    task completes. Callbacks are called with the task data of completed
+    tasks (status SUCCEEDED or FAILED) and may add new tasks; a callback
+    returning a coroutine has it run as a separate asyncio task, so that
+    polling continues while it runs.
+
+    Parameters
+    ----------
+    poll_min : float, optional
+      Shortest polling interval in seconds.
+    poll_max : float, optional
+      Longest polling interval in seconds.
+    backoff : float, optional
+      Factor by which the polling interval grows.
+    """
+
+    def __init__(self, poll_min=POLL_MIN, poll_max=POLL_MAX, backoff=1.5):
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.backoff = backoff
+        self._callbacks = {}
+        self._running = set()
+        self.status = {}
+
+    def add(self, task_data_or_id, callback=None):
+        """Track a task, calling `callback(task_data)` when it completes."""
+        if isinstance(task_data_or_id, dict):
+            task_id = task_data_or_id['task_id']
+        else:
+            task_id = task_data_or_id
+
+        logger.info(f'waiting on: {task_id}')
+        self._callbacks.setdefault(task_id, [])
+        if callback is not None:
+            self._callbacks[task_id].append(callback)
+
+    async def _query(self, task_ids):
+        """Return the task data of `task_ids` from a single `task list` call."""
+        cmd = ['globus', 'task', 'list', '--format=json', '--limit=1000']
+        cmd += [f'--filter-task-id={task_id}' for task_id in task_ids]
+
+        p = await asyncio.create_subprocess_exec(*cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = await p.communicate()
+        if p.returncode != 0:
+            logger.warning(f'task list failed: {stderr.decode("UTF-8")}')
+            return {}
+
+        task_data = json.loads(stdout.decode('UTF-8'))
+        return {d['task_id']: d for d in task_data['DATA']}
+
+    async def run(self):
+        """Poll until all tracked tasks have completed."""
+        interval = self.poll_min
+        while self._callbacks or self._running:
+            if self._running:
+                finished, _ = await asyncio.wait(self._running, timeout=interval)
+                for future in finished:
+                    self._running.discard(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # keep tracking the other tasks
+                        logger.warning(f'transfer callback failed: {e!r}')
+                if not self._callbacks:
+                    continue
+            else:
+                await asyncio.sleep(interval)
+
+            task_ids = list(self._callbacks)
+            task_data = {}
+            for i in range(0, len(task_ids), 1000):
+                task_data.update(await self._query(task_ids[i:i + 1000]))
+
+            done = [task_id for task_id, d in task_data.items()
+                    if task_id in self._callbacks and d['status'] in ['SUCCEEDED', 'FAILED']]
+
+            for task_id in done:
+                logger.info(f'transfer status: {task_id} {task_data[task_id]["status"]}')
+                self.status[task_id] = task_data[task_id]
+                for callback in self._callbacks.pop(task_id):
+                    result = callback(task_data[task_id])
+                    if asyncio.iscoroutine(result):
+                        self._running.add(asyncio.ensure_future(result))
+
+            if done:
+                interval = self.poll_min
+            else:
+                interval = min(interval * self.backoff, self.poll_max)
+
+    def wait(self):
+        """Block until all tracked tasks have completed."""
+        asyncio.run(self.run())
+
+
 def wait(task_data_or_id):
     """Wait on a globus task.
 
     Parameters
     ----------
     task_data_or_id : str or dict
-        Can be dict as returned from `transfer_async` or the `task_id` entry if __name__ == '__main__':
-            such a dictionary.
+        Can be dict as returned from `transfer_async` or the `task_id` entry of
+        such a dictionary.
 
     Returns
     -------
@@ -272,27 +477,11 @@ def wait(task_data_or_id):
     else:
         task_id = task_data_or_id
 
-    logger.info(f'waiting on: {task_id}')
-
-    # there seems to be some kind of bug: when I run this
-    # under a "click" context, it returns non-zero exit code
-    # without the -vvv flag.
-    cmd = ['globus', 'task', 'wait', '--polling-interval', '15',
-           '-vvv',
-           '--format', 'json', task_id]
-
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    stdout = stdout.decode('UTF-8')
-    stderr = stderr.decode('UTF-8')
+    monitor = TransferMonitor()
+    monitor.add(task_id)
+    monitor.wait()
 
-    if p.returncode != 0:
-        print(stdout)
-        raise OSError(stderr)
-
-    task_data = json.loads(stdout)
-
-    logger.info(f'transfer status: {task_data["status"]}')
+    task_data = monitor.status[task_id]
 
     if task_data['status'] != 'SUCCEEDED':
         with open(f'{tmpdir}/{task_id}.failure.json', 'w') as fid:
@@ -352,6 +541,135 @@ def transfer(src_ep, dst_ep, src_paths=[],
     return False
 
 
+class TransferBatcher(object):
+    """Collect files and transfer them in batches.
+
+    A batch is submitted as a single globus task once it holds `max_files`
+    files or `max_bytes` bytes, and when the batcher is closed. Submitted
+    batches are tracked by one `TransferMonitor`; failed batches are
+    resubmitted and source files are removed only after their batch task
+    has SUCCEEDED. Files may be added from several threads.
+
+    Parameters
+    ----------
+    src_ep : str
+      Source endpoint name; must be in defined endpoints.
+    dst_ep : str
+      Destination endpoint name; must be in defined endpoints.
+    max_files : int, optional
+      Number of files at which to submit a batch.
+    max_bytes : int, optional
+      Total size at which to submit a batch.
+    retry : int, optional
+      Number of times to retry each batch.
+    cleanup : boolean, optional
+      Remove source files after a successful transfer.
+    """
+
+    def __init__(self, src_ep, dst_ep, max_files=MAX_BATCH_FILES,
+                 max_bytes=MAX_BATCH_BYTES, retry=3, cleanup=True):
+        self.src_ep = src_ep
+        self.dst_ep = dst_ep
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.retry = retry
+        self.cleanup = cleanup
+
+        self._src_paths = []
+        self._dst_paths = []
+        self._nbytes = 0
+        self.failed = []
+        self.monitor = TransferMonitor()
+        self._lock = threading.RLock()
+
+    def add(self, src_path, dst_path):
+        """Add a file to the current batch; submit it if full."""
+        with self._lock:
+            self._src_paths.append(src_path)
+            self._dst_paths.append(dst_path)
+            self._nbytes += os.path.getsize(src_path)
+
+            if len(self._src_paths) >= self.max_files or self._nbytes >= self.max_bytes:
+                self.flush()
+
+    def flush(self):
+        """Submit the current batch without waiting for it to complete."""
+        with self._lock:
+            if not self._src_paths:
+                return
+
+            src_paths, self._src_paths = self._src_paths, []
+            dst_paths, self._dst_paths = self._dst_paths, []
+            self._nbytes = 0
+
+        logger.info(f'transferring batch of {len(src_paths)} files')
+        fid, batch_file = tempfile.mkstemp(suffix='.filelist', prefix='globus.batch.',
+                                           dir=tmpdir)
+        with open(batch_file, 'w') as fid:
+            for src_path, dst_path in zip(src_paths, dst_paths):
+                fid.write(f'{src_path} {dst_path}\n')
+
+        self._submit(batch_file, src_paths, self.retry)
+
+    def _transfer(self, batch_file):
+        """Submit a batch file once there is room in the task list (blocking)."""
+        wait_tasklist()
+        return transfer_async(get_endpoint_uuid(self.src_ep),
+                              get_endpoint_uuid(self.dst_ep),
+                              batch_file=batch_file)
+
+    def _track(self, task_data, batch_file, src_paths, retry):
+        self.monitor.add(task_data, lambda task_data: self._done(
+            task_data, batch_file, src_paths, retry))
+
+    def _submit(self, batch_file, src_paths, retry):
+        self._track(self._transfer(batch_file), batch_file, src_paths, retry)
+
+    async def _resubmit(self, batch_file, src_paths, retry):
+        """Resubmit a batch from the monitor without blocking its polling."""
+        loop = asyncio.get_running_loop()
+        try:
+            task_data = await loop.run_in_executor(None, self._transfer, batch_file)
+        except Exception as e:
+            logger.warning(f'batch transfer resubmission failed: {batch_file}: {e!r}')
+            self.failed.extend(src_paths)
+            return
+        self._track(task_data, batch_file, src_paths, retry)
+
+    def _done(self, task_data, batch_file, src_paths, retry):
+        """Clean up after a successful batch; resubmit a failed one."""
+        if task_data['status'] == 'SUCCEEDED':
+            if self.cleanup:
+                for src_path in src_paths:
+                    os.remove(src_path)
+        elif retry > 1:
+            logger.warning(f'batch transfer failed, retrying: {batch_file}')
+            return self._resubmit(batch_file, src_paths, retry - 1)
+        else:
+            logger.warning(f'batch transfer failed: {batch_file}')
+            with open(f'{tmpdir}/{task_data["task_id"]}.failure.json', 'w') as fid:
+                json.dump(task_data, fid)
+            self.failed.extend(src_paths)
+
+    def close(self):
+        """Transfer any remaining files and wait for all batches to complete.
+
+        Returns
+        -------
+        status : boolean
+            Returns `True` if every batch succeeded; otherwise returns `False`.
+        """
+        self.flush()
+        self.monitor.wait()
+        return not self.failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 @click.command()
 @click.option('--src-ep')
 @click.option('--dst-ep')
@@ -359,13 +677,22 @@ def transfer(src_ep, dst_ep, src_paths=[],
 @click.option('--dst-paths', default=[])
 @click.option('--batch-file', default=None)
 @click.option('--retry', default=3)
-def main(src_ep, dst_ep, src_paths, dst_paths, batch_file, retry):
+@click.option('--cleanup', default=False, is_flag=True)
+@click.option('--max-files', default=MAX_BATCH_FILES)
+def main(src_ep, dst_ep, src_paths, dst_paths, batch_file, retry, cleanup, max_files):
     """Command line interface to `transfer`."""
     if isinstance(src_paths, str):
         src_paths = src_paths.split(',')
     if isinstance(dst_paths, str):
         dst_paths = dst_paths.split(',')
 
+    if batch_file is None:
+        batcher = TransferBatcher(src_ep, dst_ep, max_files=max_files,
+                                  retry=retry, cleanup=cleanup)
+        for src_path, dst_path in zip(src_paths, dst_paths):
+            batcher.add(src_path, dst_path)
+        return batcher.close()
+
     return transfer(src_ep, dst_ep, src_paths, dst_paths, batch_file, retry)
 
 
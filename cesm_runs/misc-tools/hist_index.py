@@ -0,0 +1,139 @@
+"""Persistent index of history-file time-axis and variable metadata."""
+
+import os
+import sys
+import json
+import sqlite3
+
+import logging
+
+import netCDF4
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+INDEX_FILENAME = '.hist_index.sqlite'
+
+_columns = ['path', 'mtime', 'size', 'time_units', 'calendar', 'time_bounds',
+            'ntime', 'tb_first', 'tb_last', 'variables', 'dimensions']
+
+# columns stored as json
+_json_columns = ['tb_first', 'tb_last', 'variables', 'dimensions']
+
+
+def scan_file(file):
+    """Read the metadata of a history file.
+
+    Returns
+    -------
+    record : dict
+      The time units, calendar and name of the time-bounds variable; the
+      first and last rows of the time bounds; the variables (in file order)
+      with their dimensions and the dimension sizes.
+    """
+    stat = os.stat(file)
+    with netCDF4.Dataset(file, 'r') as nc:
+        time = nc.variables['time']
+        tb = time.bounds
+        tb_data = nc.variables[tb]
+        tb_data.set_auto_maskandscale(False)
+        ntime = len(nc.dimensions['time'])
+
+        return dict(path=file,
+                    mtime=stat.st_mtime,
+                    size=stat.st_size,
+                    time_units=time.units,
+                    calendar=time.calendar,
+                    time_bounds=tb,
+                    ntime=ntime,
+                    tb_first=tb_data[0, :].tolist(),
+                    tb_last=tb_data[ntime - 1, :].tolist(),
+                    variables=[[v, list(var.dimensions)]
+                               for v, var in nc.variables.items()],
+                    dimensions={d: len(dim) for d, dim in nc.dimensions.items()})
+
+
+class HistoryIndex(object):
+    """SQLite index of history-file metadata keyed by path, mtime and size.
+
+    Files are only opened when they are not in the index or have changed
+    on disk since they were indexed.
+
+    Parameters
+    ----------
+    db_path : str
+      Path to the SQLite database; created if it does not exist.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+            'time_units TEXT, calendar TEXT, time_bounds TEXT, ntime INTEGER, '
+            'tb_first TEXT, tb_last TEXT, variables TEXT, dimensions TEXT)')
+        self._conn.commit()
+
+    def _lookup(self, file, stat):
+        """Return the indexed record for `file` if it is current."""
+        row = self._conn.execute(
+            f'SELECT {",".join(_columns)} FROM files WHERE path = ?',
+            (file,)).fetchone()
+        if row is None:
+            return None
+
+        record = dict(zip(_columns, row))
+        if record['mtime'] != stat.st_mtime or record['size'] != stat.st_size:
+            return None
+
+        for c in _json_columns:
+            record[c] = json.loads(record[c])
+        return record
+
+    def _insert(self, record):
+        values = [json.dumps(record[c]) if c in _json_columns else record[c]
+                  for c in _columns]
+        self._conn.execute(
+            f'INSERT OR REPLACE INTO files ({",".join(_columns)}) '
+            f'VALUES ({",".join(["?"] * len(_columns))})', values)
+
+    def get(self, file):
+        """Return the metadata record for `file` (see `scan_file`)."""
+        file = os.path.abspath(file)
+        record = self._lookup(file, os.stat(file))
+        if record is None:
+            record = scan_file(file)
+            self._insert(record)
+            self._conn.commit()
+        return record
+
+    def update(self, files):
+        """Index all new or changed files in `files`.
+
+        Returns
+        -------
+        nscan : int
+          Number of files that were opened.
+        """
+        nscan = 0
+        for file in files:
+            file = os.path.abspath(file)
+            if self._lookup(file, os.stat(file)) is None:
+                self._insert(scan_file(file))
+                nscan += 1
+        self._conn.commit()
+        logger.info(f'indexed {nscan} new or changed files of {len(files)}')
+        return nscan
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
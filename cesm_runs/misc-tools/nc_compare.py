@@ -1,17 +1,140 @@
 #! /usr/bin/env python
 import os
 import click
-import xarray as xr
+import netCDF4
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-@click.command()
-@click.option('--rtol', default=1e-5, help='Relative tolerance')
-@click.option('--atol', default=1e-8, help='Absolute tolerance')
-@click.argument('file1')
-@click.argument('file2')
+# elements read per variable and file at a time
+CHUNK_SIZE = 16 * 1024**2
+
+
+def _attrs(nc_obj):
+    return {k: nc_obj.getncattr(k) for k in nc_obj.ncattrs()}
+
+
+def _attrs_equal(a1, a2):
+    if a1.keys() != a2.keys():
+        return False
+    for k in a1:
+        x, y = np.asarray(a1[k]), np.asarray(a2[k])
+        equal_nan = x.dtype.kind == 'f' and y.dtype.kind == 'f'
+        if not np.array_equal(x, y, equal_nan=equal_nan):
+            return False
+    return True
+
+
+def _read(var, index):
+    """Read `var[index]` as float64 with missing values as NaN, or as is
+       for non-numeric data."""
+    data = var[index]
+    if not isinstance(data, np.ndarray):
+        data = np.asarray(data)
+    if data.dtype.kind not in 'biuf':
+        return np.ma.getdata(data), False
+    return np.ma.filled(np.ma.asarray(data, dtype=np.float64), np.nan), True
+
+
+def compare_variable(file1, file2, v, rtol=1e-5, atol=1e-8, quick=False,
+                     chunk_size=CHUNK_SIZE):
+    """Compare variable `v` of two files, reading slabs of at most
+    `chunk_size` elements along the first dimension.
+
+    Returns
+    -------
+    result : dict
+      `status` ('identical', 'close', 'different' or, with `quick`,
+      'differs' at the first difference found), the maximum absolute and
+      relative differences, the number of elements outside the tolerance
+      and whether the attributes match.
+    """
+    result = dict(variable=v, max_abs=0., max_rel=0., nmismatch=0)
+
+    with netCDF4.Dataset(file1) as nc1, netCDF4.Dataset(file2) as nc2:
+        var1, var2 = nc1.variables[v], nc2.variables[v]
+        result['attrs_equal'] = _attrs_equal(_attrs(var1), _attrs(var2))
+
+        if var1.dimensions != var2.dimensions or var1.shape != var2.shape:
+            result['status'] = 'different'
+            result['nmismatch'] = None
+            return result
+
+        shape = var1.shape
+        if shape:
+            slab = max(1, chunk_size // max(1, int(np.prod(shape[1:]))))
+            slices = [slice(i, i + slab) for i in range(0, shape[0], slab)]
+        else:
+            slices = [Ellipsis]
+
+        equal = True
+        for index in slices:
+            d1, numeric = _read(var1, index)
+            d2, _ = _read(var2, index)
 
-def compare_files(file1, file2, rtol=1e-5, atol=1e-8):
+            if not numeric:
+                same = np.array_equal(d1, d2)
+                equal &= same
+                result['nmismatch'] += 0 if same else int(np.sum(d1 != d2))
+            else:
+                equal &= np.array_equal(d1, d2, equal_nan=True)
+                diff = np.abs(d1 - d2)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    rel = np.where(d2 != 0, diff / np.abs(d2), 0.)
+                if np.any(np.isfinite(diff)):
+                    result['max_abs'] = max(result['max_abs'], float(np.nanmax(diff)))
+                    result['max_rel'] = max(result['max_rel'], float(np.nanmax(rel)))
+                result['nmismatch'] += int(np.sum(~np.isclose(d1, d2, rtol=rtol, atol=atol,
+                                                              equal_nan=True)))
 
+            if quick and not equal:
+                result['status'] = 'differs'
+                return result
+
+    if equal and result['attrs_equal']:
+        result['status'] = 'identical'
+    elif quick:
+        # only the attributes differ
+        result['status'] = 'differs'
+    elif result['nmismatch'] == 0:
+        result['status'] = 'close'
+    else:
+        result['status'] = 'different'
+    return result
+
+
+def compare(file1, file2, rtol=1e-5, atol=1e-8, quick=False, max_workers=None, pool=None):
+    """Compare all variables and the global attributes of two files,
+    distributing variables across the processes of `pool`, or of a new
+    pool of `max_workers` processes.
+
+    Returns
+    -------
+    results : dict
+      Result of `compare_variable` for each variable in both files.
+    missing : list
+      Variables in `file1` that are not in `file2`.
+    attrs_equal : bool
+      Whether the global attributes match.
+    """
+    with netCDF4.Dataset(file1) as nc1, netCDF4.Dataset(file2) as nc2:
+        varlist = [v for v in nc1.variables if v in nc2.variables]
+        missing = [v for v in nc1.variables if v not in nc2.variables]
+        attrs_equal = _attrs_equal(_attrs(nc1), _attrs(nc2))
+
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            return compare(file1, file2, rtol, atol, quick, pool=pool)
+
+    n = len(varlist)
+    results = pool.map(compare_variable, [file1] * n, [file2] * n, varlist,
+                       [rtol] * n, [atol] * n, [quick] * n)
+    results = {r['variable']: r for r in results}
+
+    return results, missing, attrs_equal
+
+
+def report(file1, file2, rtol=1e-5, atol=1e-8, quick=False, max_workers=None, pool=None):
+    """Print the comparison of two files; returns True if they are equal."""
     if not os.path.exists(file1):
         raise FileNotFoundError(file1)
 
@@ -19,43 +142,71 @@ def compare_files(file1, file2, rtol=1e-5, atol=1e-8):
         raise FileNotFoundError(file2)
 
     print(f'Examining:\n(1) {file1}\n(2) {file2}')
-    ds1 = xr.open_dataset(file1, decode_times=False, decode_coords=False)
-    ds2 = xr.open_dataset(file2, decode_times=False, decode_coords=False)
+    results, missing, attrs_equal = compare(file1, file2, rtol, atol, quick, max_workers, pool)
 
+    for v in missing:
+        print(f'missing {v} in (2)')
 
-    compare_results = {}
-    equal = []
-    close = []
-    for v in ds1.variables:
-        if v not in ds2.variables:
-            print(f'missing {v} in (2)')
-        else:
-            try:
-                xr.testing.assert_identical(ds1[v], ds2[v])
-                compare_results[v] = 'identical'
-                equal.append(True)
-                close.append(True)
-            except:
-                try:
-                    xr.testing.assert_allclose(ds1[v], ds2[v], rtol=rtol, atol=atol)
-                    compare_results[v] = 'close'
-                    equal.append(False)
-                    close.append(True)
-                except:
-                    compare_results[v] = 'different'
-                    equal.append(False)
-                    close.append(False)
+    equal = all(r['status'] == 'identical' for r in results.values())
+    print(f'All equal: {equal}')
+    if not attrs_equal:
+        print('Global attributes differ')
+
+    if not equal:
+        if not quick:
+            close = all(r['status'] in ['identical', 'close'] for r in results.values())
+            print(f'All close: {close}')
+        for v, r in results.items():
+            if quick or r['status'] == 'identical':
+                print(f'{v}: {r["status"]}')
+            else:
+                print(f'{v}: {r["status"]} (max abs diff {r["max_abs"]:g}, '
+                      f'max rel diff {r["max_rel"]:g}, {r["nmismatch"]} mismatches'
+                      f'{"" if r["attrs_equal"] else ", attributes differ"})')
+
+    return equal and not missing
+
+
+@click.command()
+@click.option('--rtol', default=1e-5, help='Relative tolerance')
+@click.option('--atol', default=1e-8, help='Absolute tolerance')
+@click.option('--quick', default=False, is_flag=True,
+              help='Stop comparing each variable at the first difference')
+@click.option('--max-workers', default=None, type=int, help='Number of processes')
+@click.argument('file1')
+@click.argument('file2')
 
+def compare_files(file1, file2, rtol=1e-5, atol=1e-8, quick=False, max_workers=None):
+    """Compare two netCDF files, or the files with matching names in two
+    directories."""
 
-    print(f'All equal: {all(equal)}')
+    if not (os.path.isdir(file1) and os.path.isdir(file2)):
+        report(file1, file2, rtol, atol, quick, max_workers)
+        return
 
-    if not all(equal):
-        print(f'All close: {all(close)}')
-        for v, result in compare_results.items():
-            print(f'{v}: {result}')
+    files1 = sorted(f for f in os.listdir(file1) if f.endswith('.nc'))
+    files2 = set(f for f in os.listdir(file2) if f.endswith('.nc'))
 
+    differ = []
+    nequal = 0
+    # one pool for all files
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for f in files1:
+            if f not in files2:
+                print(f'missing {f} in (2)')
+            elif report(os.path.join(file1, f), os.path.join(file2, f),
+                        rtol, atol, quick, pool=pool):
+                nequal += 1
+            else:
+                differ.append(f)
+            print()
 
+    for f in sorted(files2 - set(files1)):
+        print(f'missing {f} in (1)')
 
+    print(f'{nequal} of {len(files1)} files equal')
+    for f in differ:
+        print(f'differ: {f}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,205 @@
+"""Local process-pool backend with the `submit`/`wait` interface of
+`workflow.task_manager`.
+"""
+
+import os
+import sys
+import re
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from subprocess import Popen, STDOUT
+from time import sleep, time
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+_units = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+
+def parse_memory(memory):
+    """Convert a memory request like '100GB' to bytes."""
+    if memory is None:
+        return 0
+    if isinstance(memory, (int, float)):
+        return int(memory)
+
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', memory.upper())
+    if match is None:
+        raise ValueError(f'cannot parse memory: {memory}')
+    return int(float(match.group(1)) * _units[match.group(2)])
+
+
+def physical_memory():
+    """Return the physical memory of this node in bytes."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _script(cmds, modules):
+    """Return a bash script running `cmds` in sequence; stops on error."""
+    lines = ['set -e']
+    if modules and 'MODULESHOME' in os.environ:
+        lines += [f'source {os.environ["MODULESHOME"]}/init/bash',
+                  f'module load {" ".join(modules)}']
+    lines += [' '.join(cmd) for cmd in cmds if cmd]
+    return '\n'.join(lines) + '\n'
+
+
+def _run_task(task_id, cmds, modules, retry, logfile):
+    """Run a task in a worker process, retrying on failure.
+
+    Returns
+    -------
+    result : dict
+      Return code, number of attempts, elapsed time and the peak resident
+      memory (bytes) of the task's process tree.
+    """
+    script = _script(cmds, modules)
+    t0 = time()
+    maxrss = 0
+    for attempt in range(1, retry + 2):
+        with open(logfile, 'a') as fid:
+            fid.write(f'# task {task_id}, attempt {attempt}\n')
+            fid.flush()
+            p = Popen(['bash', '-c', script], stdout=fid, stderr=STDOUT)
+            _, status, rusage = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+
+        # ru_maxrss is in kilobytes on Linux
+        maxrss = max(maxrss, rusage.ru_maxrss * 1024)
+        if p.returncode == 0:
+            break
+        if attempt <= retry:
+            sleep(min(10 * attempt, 60))
+
+    return dict(task_id=task_id, returncode=p.returncode, attempts=attempt,
+                elapsed=time() - t0, maxrss=maxrss, logfile=logfile)
+
+
+class TaskPool(object):
+    """Run task-manager style jobs in a local process pool.
+
+    Tasks are started only while the sum of their memory requests fits in
+    `max_memory`; a task requesting more than `max_memory` runs alone.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+      Number of worker processes; defaults to the number of CPUs.
+    max_memory : str or int, optional
+      Memory available to tasks, e.g. '500GB'; defaults to physical memory.
+    retry : int, optional
+      Number of times to rerun a failing task.
+    logdir : str, optional
+      Directory for task logs; defaults to $TMPDIR.
+    """
+
+    def __init__(self, max_workers=None, max_memory=None, retry=2, logdir=None):
+        self.max_workers = max_workers or os.cpu_count()
+        self.max_memory = parse_memory(max_memory) or physical_memory()
+        self.retry = retry
+        self.logdir = logdir or os.environ.get('TMPDIR', tempfile.gettempdir())
+
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._running = {}
+        self._reserved = 0
+        self._ntask = 0
+        self._ncomplete = 0
+        self.results = {}
+
+    def submit(self, cmds, modules=[], memory=None, callback=None, **kwargs):
+        """Queue a list of commands to be run in sequence.
+
+        `callback(result)`, if given, is called with the task's result (see
+        `_run_task`) once it completes.
+
+        Returns
+        -------
+        task_id : int
+        """
+        with self._lock:
+            self._ntask += 1
+            task_id = self._ntask
+            memory = min(parse_memory(memory), self.max_memory)
+            self._pending.append((task_id, cmds, modules, memory, callback))
+            self._launch()
+        return task_id
+
+    def _launch(self):
+        """Start pending tasks while workers and memory are available;
+           must be called with the lock held.
+        """
+        while self._pending and len(self._running) < self.max_workers:
+            task_id, cmds, modules, memory, callback = self._pending[0]
+            if self._running and self._reserved + memory > self.max_memory:
+                break
+
+            self._pending.popleft()
+            self._reserved += memory
+            self._running[task_id] = (memory, callback)
+            logfile = os.path.join(self.logdir, f'task_pool.{os.getpid()}.{task_id}.out')
+            future = self._pool.submit(_run_task, task_id, cmds, modules,
+                                       self.retry, logfile)
+            future.add_done_callback(
+                lambda f, task_id=task_id: self._done(task_id, f))
+
+    def _done(self, task_id, future):
+        """Release the task's memory, record its result, start more tasks
+           and call the task's callback."""
+        try:
+            result = future.result()
+        except Exception as e:
+            result = dict(task_id=task_id, returncode=-1, error=repr(e))
+
+        with self._lock:
+            memory, callback = self._running.pop(task_id)
+            self._reserved -= memory
+
+            if result['returncode'] != 0:
+                logger.warning(f'task {task_id} failed: {result}')
+            elif result['maxrss'] > memory > 0:
+                logger.warning(f'task {task_id} used {result["maxrss"]} bytes, '
+                               f'more than the {memory} requested')
+
+            self.results[task_id] = result
+            self._launch()
+
+        # outside the lock: callbacks may take a while
+        if callback is not None:
+            try:
+                callback(result)
+            except Exception as e:
+                logger.warning(f'task {task_id} callback failed: {e!r}')
+
+        with self._lock:
+            self._ncomplete += 1
+            self._lock.notify_all()
+
+    def wait(self):
+        """Wait for all tasks to complete.
+
+        Returns
+        -------
+        status : boolean
+          Returns `True` if all tasks succeeded; otherwise returns `False`.
+        """
+        with self._lock:
+            while self._pending or self._running or self._ncomplete < self._ntask:
+                self._lock.wait()
+
+        failed = [r for r in self.results.values() if r['returncode'] != 0]
+        logger.info(f'{len(self.results)} tasks complete, {len(failed)} failed')
+        return not failed
+
+    def shutdown(self):
+        """Wait for tasks and shut down the worker processes."""
+        self.wait()
+        self._pool.shutdown()
@@ -0,0 +1,342 @@
+#! /usr/bin/env python
+"""Split history files into per-variable timeseries files in a single pass."""
+
+import os
+import sys
+import shutil
+import click
+
+import logging
+
+import yaml
+import numpy as np
+import netCDF4
+
+import hist_index
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+
+# maximum number of output files held open at once; each batch of
+# variables requires one pass through the history files
+MAX_OPEN_FILES = 256
+
+
+def tseries_filename(case, stream, variable, date_string):
+    """Return the basename of a timeseries file."""
+    return '.'.join([case, stream, variable, date_string, 'nc'])
+
+
+def get_encoding(component, stream):
+    """Return the compression settings for a stream from `cesm_streams.yml`.
+
+    Returns
+    -------
+    encoding : dict
+      Keys `zlib`, `complevel`, `shuffle` and `chunksizes`, the latter a
+      dictionary of chunk length by dimension name; empty if the stream
+      has no `encoding` entry.
+    """
+    with open(f'{script_path}/cesm_streams.yml') as f:
+        streams = yaml.safe_load(f)
+    return streams[component][stream].get('encoding', {})
+
+
+def _variable_encoding(var_in, nc_in, encoding):
+    """Return `createVariable` keyword arguments for compression and chunking.
+
+    Character and string variables, including variable-length strings
+    (dtype `str`), are written without either.
+    """
+    if not encoding or not var_in.dimensions:
+        return {}
+    if not isinstance(var_in.dtype, np.dtype) or var_in.dtype.kind in 'SU':
+        return {}
+
+    kwargs = dict(zlib=encoding.get('zlib', True),
+                  complevel=encoding.get('complevel', 1),
+                  shuffle=encoding.get('shuffle', True))
+
+    chunks = encoding.get('chunksizes', {})
+    if any(d in chunks for d in var_in.dimensions):
+        # dimensions not listed are a single chunk
+        kwargs['chunksizes'] = []
+        for d in var_in.dimensions:
+            dim = nc_in.dimensions[d]
+            if d not in chunks:
+                kwargs['chunksizes'].append(len(dim))
+            elif dim.isunlimited():
+                kwargs['chunksizes'].append(chunks[d])
+            else:
+                kwargs['chunksizes'].append(min(chunks[d], len(dim)))
+    return kwargs
+
+
+def _create_variable(nc_out, nc_in, v, encoding=None):
+    """Define variable `v` of `nc_in` in `nc_out`, including its dimensions."""
+    var_in = nc_in.variables[v]
+
+    for d in var_in.dimensions:
+        if d not in nc_out.dimensions:
+            dim = nc_in.dimensions[d]
+            nc_out.createDimension(d, None if dim.isunlimited() else len(dim))
+
+    attrs = {k: var_in.getncattr(k) for k in var_in.ncattrs()}
+    fill_value = attrs.pop('_FillValue', None)
+
+    var_out = nc_out.createVariable(v, var_in.dtype, var_in.dimensions,
+                                    fill_value=fill_value,
+                                    **_variable_encoding(var_in, nc_in, encoding))
+    var_out.setncatts(attrs)
+    return var_out
+
+
+def _open_output(file_out, nc_in, varlist, encoding=None):
+    """Create an output file with the dimensions, attributes and variables
+       of `nc_in` listed in `varlist`.
+    """
+    nc_out = netCDF4.Dataset(f'{file_out}.tmp', 'w', format='NETCDF4')
+    nc_out.set_auto_maskandscale(False)
+    nc_out.setncatts({k: nc_in.getncattr(k) for k in nc_in.ncattrs()})
+
+    for v in varlist:
+        var_out = _create_variable(nc_out, nc_in, v, encoding)
+        if 'time' not in var_out.dimensions:
+            var_out[...] = nc_in.variables[v][...]
+
+    return nc_out
+
+
+def split_files(files, static_vars, time_vars, file_out, max_open=MAX_OPEN_FILES,
+                file_append=None, encoding=None):
+    """Write each time-varying variable in `files` to its own timeseries file.
+
+    Each history file is opened once per batch of `max_open` variables and
+    every variable in the batch is appended to its output file, in
+    contrast to one `ncrcat` per variable. Output is written to
+    `{file_out}.tmp` and moved into place once complete.
+
+    Variables listed in `file_append` are instead appended along the
+    unlimited `time` dimension of a copy of an existing timeseries file,
+    which replaces it as `file_out` once complete; the existing file is
+    left untouched if the task fails and is retried.
+
+    Parameters
+    ----------
+    files : list
+      Sorted list of history files.
+    static_vars : list
+      Variables written to every output file (see `get_vars`); those with
+      a `time` dimension are concatenated along with the data.
+    time_vars : list
+      Time-varying variables; one output file is written for each.
+    file_out : dict
+      Output filename for each variable in `time_vars`.
+    max_open : int, optional
+      Maximum number of output files open at once.
+    file_append : dict, optional
+      Existing timeseries file to append to for some or all of `time_vars`.
+    encoding : dict, optional
+      Compression and chunking of new files (see `get_encoding`); if
+      omitted, output is uncompressed.
+    """
+    if file_append is None:
+        file_append = {}
+
+    for b in range(0, len(time_vars), max_open):
+        batch = time_vars[b:b + max_open]
+
+        nc_out = {}
+        nt = {}
+        try:
+            for i, f in enumerate(files):
+                with netCDF4.Dataset(f, 'r') as nc_in:
+                    nc_in.set_auto_maskandscale(False)
+
+                    if i == 0:
+                        for v in batch:
+                            if v in file_append:
+                                logger.info(f'appending to {file_append[v]}')
+                                shutil.copyfile(file_append[v], f'{file_out[v]}.tmp')
+                                nc_out[v] = netCDF4.Dataset(f'{file_out[v]}.tmp', 'a')
+                                nc_out[v].set_auto_maskandscale(False)
+                            else:
+                                logger.info(f'creating {file_out[v]}')
+                                varlist = [s for s in static_vars if s in nc_in.variables]
+                                nc_out[v] = _open_output(file_out[v], nc_in, varlist + [v],
+                                                         encoding)
+                            nt[v] = len(nc_out[v].dimensions['time'])
+
+                    nt_i = len(nc_in.dimensions['time'])
+
+                    # read once, write to every file in the batch
+                    static_data = {s: nc_in.variables[s][...] for s in static_vars
+                                   if s in nc_in.variables and
+                                   'time' in nc_in.variables[s].dimensions}
+
+                    for v in batch:
+                        tslice = slice(nt[v], nt[v] + nt_i)
+                        for s, data in static_data.items():
+                            nc_out[v].variables[s][tslice, ...] = data
+                        nc_out[v].variables[v][tslice, ...] = nc_in.variables[v][...]
+                        nt[v] += nt_i
+        finally:
+            for nc in nc_out.values():
+                nc.close()
+
+        for v in batch:
+            os.rename(f'{file_out[v]}.tmp', file_out[v])
+            if v in file_append and file_append[v] != file_out[v]:
+                os.remove(file_append[v])
+
+
+def zarr_storename(case, stream):
+    """Return the basename of the Zarr store for a stream."""
+    return '.'.join([case, stream, 'zarr'])
+
+
+def write_zarr(files, store, static_vars, time_vars, encoding=None, index=None):
+    """Write history files to a consolidated Zarr store with one array per
+       variable, appending along `time` if the store exists.
+
+    Only history files with time bounds ending after those of an existing
+    store are read; their ends are looked up in `index` or read from the
+    time bounds alone, newest first, until a file already in the store is
+    found. Writes are aligned with the `time` chunks of the store, so each
+    chunk is written by a single task.
+
+    Parameters
+    ----------
+    files : list
+      Sorted list of history files.
+    store : str
+      Path to the Zarr store.
+    static_vars : list
+      Variables without a `time` dimension are written once, when the store
+      is created; `time` and its bounds are appended with the data.
+    time_vars : list
+      Time-varying variables.
+    encoding : dict, optional
+      Stream encoding (see `get_encoding`); `chunksizes` sets the chunks of
+      each array.
+    index : hist_index.HistoryIndex, optional
+      Index of the history files' time axes.
+    """
+    import xarray as xr
+
+    chunks = (encoding or {}).get('chunksizes', {})
+    xr_open = dict(decode_times=False, decode_coords=False)
+
+    nt_existing = 0
+    if os.path.exists(store):
+        with xr.open_zarr(store, consolidated=True, **xr_open) as ds:
+            nt_existing = ds.sizes['time']
+            tb_last = ds[ds.time.attrs['bounds']].values[-1, -1]
+
+        # files are sorted by date: only the new ones and the last one
+        # already in the store are looked at
+        nnew = 0
+        for f in reversed(files):
+            record = index.get(f) if index is not None else hist_index.scan_file(f)
+            if record['tb_last'][-1] <= tb_last:
+                break
+            nnew += 1
+        files = files[len(files) - nnew:]
+
+    if not files:
+        logger.info(f'{store} is up to date')
+        return
+
+    ds = xr.open_mfdataset(files, data_vars='minimal', coords='minimal',
+                           compat='override', combine='nested', concat_dim='time',
+                           **xr_open)
+    ds = ds[[v for v in static_vars + time_vars if v in ds.variables]]
+
+    # align dask chunks with zarr chunks, starting from the end of the store
+    tchunk = chunks.get('time', 1)
+    nt = ds.sizes['time']
+    time_chunks = [min((tchunk - nt_existing % tchunk) % tchunk or tchunk, nt)]
+    while sum(time_chunks) < nt:
+        time_chunks.append(min(tchunk, nt - sum(time_chunks)))
+    ds = ds.chunk({d: chunks.get(d, -1) for d in ds.dims if d != 'time'})
+    ds = ds.chunk({'time': tuple(time_chunks)})
+
+    if nt_existing:
+        logger.info(f'appending {nt} time levels to {store}')
+        ds = ds[[v for v in ds.data_vars if 'time' in ds[v].dims]]
+        ds.to_zarr(store, mode='a', append_dim='time', consolidated=True)
+    else:
+        logger.info(f'creating {store}')
+        encoding = {v: {'chunks': tuple(tchunk if d == 'time'
+                                        else min(chunks.get(d, ds.sizes[d]), ds.sizes[d])
+                                        for d in ds[v].dims)}
+                    for v in ds.variables if ds[v].dims}
+        for v in ds.variables:
+            ds[v].encoding = {}
+        ds.to_zarr(store, mode='w', consolidated=True, encoding=encoding)
+
+
+@click.command()
+@click.argument('filelist')
+@click.option('--case', required=True)
+@click.option('--stream', required=True)
+@click.option('--date-string', default=None)
+@click.option('--dout', required=True)
+@click.option('--static-vars', required=True)
+@click.option('--time-vars', required=True)
+@click.option('--max-open', default=MAX_OPEN_FILES)
+@click.option('--append-date-string', default=None)
+@click.option('--component', default=None)
+@click.option('--zarr', default=False, is_flag=True)
+@click.option('--index', default=None)
+def main(filelist, case, stream, date_string, dout, static_vars, time_vars,
+         max_open=MAX_OPEN_FILES, append_date_string=None, component=None,
+         zarr=False, index=None):
+    """Command line interface to `split_files` and `write_zarr`."""
+    with open(filelist) as fid:
+        files = [l.strip() for l in fid if l.strip()]
+
+    static_vars = static_vars.split(',')
+    time_vars = time_vars.split(',')
+
+    if zarr:
+        encoding = get_encoding(component, stream) if component is not None else None
+        if index is not None:
+            index = hist_index.HistoryIndex(index)
+        try:
+            write_zarr(files, os.path.join(dout, zarr_storename(case, stream)),
+                       static_vars, time_vars, encoding=encoding, index=index)
+        finally:
+            if index is not None:
+                index.close()
+        return
+
+    if date_string is None:
+        raise ValueError('date string required')
+
+    file_out = {v: os.path.join(dout, tseries_filename(case, stream, v, date_string))
+                for v in time_vars}
+
+    # extend existing timeseries files, e.g. 000101-006212 --> 000101-006412
+    file_append = {}
+    if append_date_string is not None:
+        file_append = {v: os.path.join(dout, tseries_filename(case, stream, v,
+                                                              append_date_string))
+                       for v in time_vars}
+
+    # compress as configured for the stream in cesm_streams.yml
+    encoding = None
+    if component is not None:
+        encoding = get_encoding(component, stream)
+
+    split_files(files, static_vars, time_vars, file_out, max_open=max_open,
+                file_append=file_append, encoding=encoding)
+
+
+if __name__ == '__main__':
+    main()
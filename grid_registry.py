@@ -0,0 +1,119 @@
+"""Grid weights and masks for the POP gx1v7 and CAM fv 0.9x1.25 grids.
+
+Each grid is computed once, cached to a small netCDF file in `cache_dir`
+and held in memory thereafter. The arrays handed out are read-only and
+shared by all callers; weights that vary along only one dimension are
+broadcast views.
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+
+import util
+
+inputdata = '/glade/p/cesmdata/cseg/inputdata'
+
+cache_dir = os.environ.get('GRID_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'xtfe-grids'))
+
+fv_files = dict(
+    coords=f'{inputdata}/atm/cam/coords/fv_0.9x1.25.nc',
+    domain=f'{inputdata}/atm/cam/ocnfrac/domain.camocn.0.9x1.25_gx1v7_170215.nc',
+)
+
+# POP region masks, from the grid dataset
+REGIONS = {
+    'global': lambda grid: grid.KMT > 0,
+    'southern_ocean': lambda grid: (grid.TLAT < -40) & (grid.KMT > 0),
+}
+
+# depth (cm) of the upper-ocean layer weighted by `dz_upper`
+Z_UPPER = 200e2
+
+_grids = {}
+
+
+def _readonly(ds):
+    """Mark the data variables of `ds` read-only, in place."""
+    for v in ds.data_vars:
+        ds[v].values.setflags(write=False)
+    return ds
+
+
+def _cached(name, compute):
+    """Return grid `name` from the on-disk cache or `compute()` and cache it."""
+    path = os.path.join(cache_dir, f'{name}.nc')
+    if os.path.exists(path):
+        with xr.open_dataset(path) as ds:
+            grid = ds.load()
+    else:
+        grid = compute()
+        os.makedirs(cache_dir, exist_ok=True)
+        grid.to_netcdf(f'{path}.tmp', encoding={v: {'zlib': True, 'complevel': 1}
+                                                for v in grid.data_vars})
+        os.rename(f'{path}.tmp', path)
+
+    return grid
+
+
+def pop_gx1v7(ds=None):
+    """Return the POP gx1v7 grid: TAREA (m^2), KMT, TLAT, TLONG, z_t, dz,
+    the region masks in `REGIONS` as `REGION_MASK` (region, nlat, nlon),
+    area weights for each region as `REGION_AREA` and `dz_upper`, the
+    layer thickness above `Z_UPPER` (zero below).
+
+    Parameters
+    ----------
+    ds : xarray.Dataset, optional
+      POP history dataset with the grid variables; required only if the
+      grid is not yet cached.
+    """
+    def compute():
+        if ds is None:
+            raise ValueError('POP grid is not cached: a POP dataset is required')
+        # grid variables may be coordinates, e.g. from util.open_cesm_data
+        grid = xr.Dataset({v: ds[v].variable for v in ['TAREA', 'KMT', 'TLAT', 'TLONG', 'dz']},
+                          coords={'z_t': ds.z_t.variable})
+        for v in grid.variables:
+            grid[v].encoding = {}
+        grid = grid.load()
+        grid['TAREA'] = grid.TAREA * 1e-4
+        grid.TAREA.attrs['units'] = 'm^2'
+        return grid
+
+    if 'pop_gx1v7' not in _grids:
+        grid = _cached('pop_gx1v7', compute)
+
+        mask = xr.concat([REGIONS[r](grid) for r in REGIONS], dim='region')
+        grid['REGION_MASK'] = mask.assign_coords(region=list(REGIONS))
+        grid['REGION_AREA'] = grid.TAREA.where(grid.REGION_MASK).fillna(0.).transpose('region', ...)
+        grid['dz_upper'] = grid.dz.where(grid.z_t < Z_UPPER).fillna(0.)
+
+        _grids['pop_gx1v7'] = _readonly(grid)
+
+    return _grids['pop_gx1v7']
+
+
+def fv09(coords_file=fv_files['coords'], domain_file=fv_files['domain']):
+    """Return the CAM fv 0.9x1.25 grid: `gw`, `area` (m^2, a broadcast
+    view), `OCNFRAC` and the ocean area `AREA` (area x OCNFRAC).
+    """
+    def compute():
+        with xr.open_dataset(coords_file) as ds:
+            grid = ds[['gw']].assign_coords(lon=ds.lon).load()
+        with xr.open_dataset(domain_file) as ds:
+            grid['OCNFRAC'] = (('lat', 'lon'), ds.frac.values)
+        return grid
+
+    if 'fv09' not in _grids:
+        grid = _cached('fv09', compute)
+
+        grid['area'] = util.compute_grid_area(grid)
+        grid['AREA'] = grid.area * grid.OCNFRAC
+        grid.AREA.attrs['units'] = 'm^2'
+
+        _grids['fv09'] = _readonly(grid)
+
+    return _grids['fv09']
@@ -0,0 +1,10 @@
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'cesm_runs'))
+sys.path.insert(0, os.path.join(root, 'cesm_runs', 'misc-tools'))
+
+# read at import by the case and transfer tools
+os.environ.setdefault('USER', 'user')
+os.environ.setdefault('TMPDIR', '/tmp')
@@ -0,0 +1,112 @@
+import pytest
+
+from cesm_case_tools import CaseConfig
+
+# abridged from a CIME 5.6 case
+ENV_MACH_PES = """<?xml version="1.0"?>
+<file id="env_mach_pes.xml" version="2.0">
+  <header>
+      These variables CANNOT be modified once case_setup has been invoked
+      without first invoking case_setup -reset
+  </header>
+  <group id="mach_pes">
+    <entry id="NTASKS">
+      <type>integer</type>
+      <values>
+        <value compclass="ATM">36</value>
+        <value compclass="CPL">36</value>
+        <value compclass="OCN">216</value>
+        <value compclass="WAV">36</value>
+        <value compclass="GLC">36</value>
+        <value compclass="ICE">36</value>
+        <value compclass="ROF">36</value>
+        <value compclass="LND">36</value>
+        <value compclass="ESP">1</value>
+      </values>
+      <desc>number of tasks for each component</desc>
+    </entry>
+    <entry id="NTHRDS">
+      <type>integer</type>
+      <values>
+        <value compclass="ATM">2</value>
+        <value compclass="CPL">2</value>
+        <value compclass="OCN">2</value>
+        <value compclass="WAV">2</value>
+        <value compclass="GLC">2</value>
+        <value compclass="ICE">2</value>
+        <value compclass="ROF">2</value>
+        <value compclass="LND">2</value>
+        <value compclass="ESP">1</value>
+      </values>
+      <desc>number of threads for each task in each component</desc>
+    </entry>
+    <entry id="ROOTPE">
+      <type>integer</type>
+      <values>
+        <value compclass="ATM">0</value>
+        <value compclass="CPL">0</value>
+        <value compclass="OCN">36</value>
+        <value compclass="WAV">0</value>
+        <value compclass="GLC">0</value>
+        <value compclass="ICE">0</value>
+        <value compclass="ROF">0</value>
+        <value compclass="LND">0</value>
+        <value compclass="ESP">0</value>
+      </values>
+      <desc>ROOTPE (mpi task in MPI_COMM_WORLD) for each component</desc>
+    </entry>
+    <!-- tasks per node of the machine -->
+    <entry id="MAX_TASKS_PER_NODE" value="36">
+      <type>integer</type>
+      <desc>maximum number of tasks/ threads allowed per node </desc>
+    </entry>
+  </group>
+</file>
+"""
+
+
+@pytest.fixture
+def caseroot(tmp_path):
+    (tmp_path / 'env_mach_pes.xml').write_text(ENV_MACH_PES)
+    return str(tmp_path)
+
+
+def test_component_entry(caseroot):
+    config = CaseConfig(caseroot)
+    assert config.get('NTASKS_OCN') == '216'
+    with pytest.raises(ValueError):
+        config.get('NTASKS')
+    assert config.get('MAX_TASKS_PER_NODE') == '36'
+
+
+def test_set_all_components(caseroot):
+    with CaseConfig(caseroot) as config:
+        config.set('NTASKS', 72)
+
+    config = CaseConfig(caseroot)
+    assert config.get('NTASKS') == '72'
+    assert config.get('NTASKS_ATM') == '72'
+    assert config.get('NTASKS_ESP') == '72'
+    entry = config._trees['env_mach_pes.xml'].getroot().find(".//entry[@id='NTASKS']")
+    assert entry.get('value') is None
+
+
+def test_set_one_component(caseroot):
+    with CaseConfig(caseroot) as config:
+        config.set('ROOTPE_OCN', 72)
+        config.set('MAX_TASKS_PER_NODE', 72)
+
+    config = CaseConfig(caseroot)
+    assert config.get('ROOTPE_OCN') == '72'
+    assert config.get('ROOTPE_ATM') == '0'
+    assert config.get('MAX_TASKS_PER_NODE') == '72'
+    with open(caseroot + '/env_mach_pes.xml') as f:
+        assert 'tasks per node of the machine' in f.read()
+
+
+def test_validate(caseroot):
+    config = CaseConfig(caseroot)
+    with pytest.raises(ValueError):
+        config.set('NTASKS', 'many')
+    with pytest.raises(KeyError):
+        config.get('NTASKS_XYZ')
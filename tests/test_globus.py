@@ -0,0 +1,39 @@
+import os
+
+import globus
+
+
+def test_resubmit_failure(monkeypatch, tmp_path):
+    """A batch whose resubmission raises is recorded as failed while the
+    other batches are still tracked and cleaned up."""
+    submitted = []
+
+    def transfer_async(src, dst, batch_file=None):
+        submitted.append(batch_file)
+        if batch_file == 'batch1' and len(submitted) > 2:
+            raise OSError('globus transfer failed')
+        return {'task_id': f'{batch_file}-{len(submitted)}'}
+
+    async def query(self, task_ids):
+        return {task_id: {'task_id': task_id,
+                          'status': 'FAILED' if task_id.startswith('batch1') else 'SUCCEEDED'}
+                for task_id in task_ids}
+
+    monkeypatch.setattr(globus, 'transfer_async', transfer_async)
+    monkeypatch.setattr(globus, 'wait_tasklist', lambda: None)
+    monkeypatch.setattr(globus, 'get_endpoint_uuid', lambda ep: ep)
+    monkeypatch.setattr(globus.TransferMonitor, '_query', query)
+
+    src1, src2 = tmp_path / 'a.nc', tmp_path / 'b.nc'
+    src1.write_text('a')
+    src2.write_text('b')
+
+    batcher = globus.TransferBatcher('glade', 'campaign')
+    batcher.monitor.poll_min = batcher.monitor.poll_max = 0.01
+    batcher._submit('batch1', [str(src1)], 3)
+    batcher._submit('batch2', [str(src2)], 3)
+
+    assert not batcher.close()
+    assert batcher.failed == [str(src1)]
+    assert os.path.exists(src1)
+    assert not os.path.exists(src2)
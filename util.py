@@ -1,47 +1,169 @@
+import os
+import re
+import pickle
+import multiprocessing
+import hashlib
+from collections import OrderedDict
 from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import cftime
+import netCDF4
 import numpy as np
+import scipy.sparse
 import xarray as xr
 
 molw_Fe = 55.845
 
 kgm2s_to_molm2yr = 1e3 / molw_Fe * 86400. * 365.
 
-def pop_add_cyclic(ds):
-    
-    nj = ds.TLAT.shape[0]
-    ni = ds.TLONG.shape[1]
+# the intake-esm collection; edits to it invalidate cached datasets
+INTAKE_CSV = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'intake-collections', 'cesm', 'xtfe-cesm-runs.cesm.csv')
 
-    xL = int(ni/2 - 1)
-    xR = int(xL + ni)
-
-    tlon = ds.TLONG.data
-    tlat = ds.TLAT.data
-    
-    tlon = np.where(np.greater_equal(tlon, min(tlon[:,0])), tlon-360., tlon)    
-    lon  = np.concatenate((tlon, tlon + 360.), 1)
-    lon = lon[:, xL:xR]
+# number of datasets held by `open_cesm_data`
+DATASET_CACHE_SIZE = 8
+_dataset_cache = OrderedDict()
+
+# `PopCyclicRemap` by grid
+_cyclic_remaps = {}
+
+# `ZonalMean` by grid, mask and latitude bands
+_zonal_means = {}
+
+# days before the start of each month (and the end of the year), noleap calendar
+noleap_cumdays = np.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+_days_per_unit = {'days': 1., 'hours': 1. / 24., 'minutes': 1. / 1440., 'seconds': 1. / 86400.}
+
+# conversions applied by `open_cesm_data`; see `register_conversion`
+conversions = {}
+
+
+def register_conversion(name, scale, units=None, long_name=None, source=None):
+    """Register a conversion applied to the output of `open_cesm_data`.
+
+    Variable `name` is set to `source` (default `name`) times `scale`,
+    keeping the attributes of `source` except `units` and `long_name`, if
+    given. Registering `name` again replaces its conversion.
+    """
+    conversions[name] = dict(scale=scale, units=units, long_name=long_name,
+                             source=name if source is None else source)
+
+
+def apply_conversions(ds):
+    """Apply the registered conversions to the variables present in `ds`.
+
+    Each constant is folded into a single scale factor, so a conversion
+    adds one elementwise operation per variable; derived variables are
+    computed from their unconverted source.
+    """
+    ds_in = ds
+    ds = ds.copy()
+    for name, conv in conversions.items():
+        if conv['source'] not in ds_in.variables:
+            continue
+        with xr.set_options(keep_attrs=True):
+            da = ds_in[conv['source']] * conv['scale']
+        for attr in ['units', 'long_name']:
+            if conv[attr] is not None:
+                da.attrs[attr] = conv[attr]
+        ds[name] = da
+    return ds
+
+
+register_conversion('IRON_FLUX', 86400. * 365. * 1e-3, units='mol m$^{-2}$ yr$^{-1}$')
+register_conversion('photoC_TOT_zint', 86400. * 365. * 1e-9 * 1e4,
+                    units='mol m$^{-2}$ yr$^{-1}$')
+register_conversion('NCP', (-1.0) * 86400. * 365. * 1e-9 * 1e4,
+                    units='mol m$^{-2}$ yr$^{-1}$', source='Jint_100m_DIC')
+register_conversion('ATM_XTFE_FLUX_CPL', 1e4 * 86400. * 365. / molw_Fe,
+                    units='mol m$^{-2}$ yr$^{-1}$')
+register_conversion('SEAICE_XTFE_FLUX_CPL', 1e4 * 86400. * 365. / molw_Fe,
+                    units='mol m$^{-2}$ yr$^{-1}$')
+register_conversion('Fe', 1e3, units='nM', long_name='dFe')
+
+
+class PopCyclicRemap(object):
+    """Wrap a POP field at the middle of its `nlon` axis and repeat the
+    first column, so that contour plots close at the seam.
+
+    The index permutation and the adjusted TLONG/TLAT are computed once
+    per grid and stored as read-only arrays; fields are extended with a
+    single gather along `nlon`.
+
+    Parameters
+    ----------
+    TLONG, TLAT : array_like
+      (nlat, nlon) grid coordinates.
+    """
+
+    def __init__(self, TLONG, TLAT):
+        tlon = np.asarray(TLONG)
+        ni = tlon.shape[1]
+
+        xL = int(ni/2 - 1)
+        x = np.arange(xL, xL + ni)
+        self.index = np.r_[x % ni, xL]
+
+        tlon = np.where(np.greater_equal(tlon, min(tlon[:,0])), tlon-360., tlon)
+        lon = tlon[:, x % ni] + np.where(x >= ni, 360., 0.)
+
+        if ni == 320:
+            lon[367:-3, 0] = lon[367:-3, 0] + 360.
+        lon = lon - 360.
+
+        lon = np.hstack((lon, lon[:, 0:1] + 360.))
+        if ni == 320:
+            lon[367:, -1] = lon[367:, -1] - 360.
+
+        #-- trick cartopy into doing the right thing:
+        #   it gets confused when the cyclic coords are identical
+        lon[:, 0] = lon[:, 0] - 1e-8
+
+        self.TLONG = lon
+        self.TLAT = np.asarray(TLAT)[:, self.index]
+        for a in [self.index, self.TLONG, self.TLAT]:
+            a.setflags(write=False)
+
+    @classmethod
+    def from_dataset(cls, ds):
+        """Return the (cached) remap for the grid of `ds`."""
+        tlon = np.asarray(ds.TLONG)
+        tlat = np.asarray(ds.TLAT)
+        key = (tlon.shape, hashlib.sha1(tlon.tobytes() + tlat.tobytes()).hexdigest())
+        if key not in _cyclic_remaps:
+            _cyclic_remaps[key] = cls(tlon, tlat)
+        return _cyclic_remaps[key]
+
+    def __call__(self, var):
+        """Return xarray.Variable `var` extended along `nlon`.
+
+        Dask-backed variables stay lazy: the wrap is built from slices of
+        the input along `nlon` and the result has the same chunks as the
+        input, with the cyclic column added to the last `nlon` chunk.
+        """
+        if var.chunks is None:
+            field = var.isel(nlon=self.index)
+        else:
+            xL = self.index[0]
+            field = xr.Variable.concat([var.isel(nlon=slice(xL, None)),
+                                        var.isel(nlon=slice(0, xL)),
+                                        var.isel(nlon=slice(xL, xL + 1))], dim='nlon')
+            nlon_chunks = var.chunks[var.get_axis_num('nlon')]
+            field = field.chunk({'nlon': nlon_chunks[:-1] + (nlon_chunks[-1] + 1,)})
+        return xr.Variable(field.dims, field.data, attrs=field.attrs)
 
-    if ni == 320:
-        lon[367:-3, 0] = lon[367:-3, 0] + 360.        
-    lon = lon - 360.
-    
-    lon = np.hstack((lon, lon[:, 0:1] + 360.))
-    if ni == 320:
-        lon[367:, -1] = lon[367:, -1] - 360.
 
-    #-- trick cartopy into doing the right thing:
-    #   it gets confused when the cyclic coords are identical
-    lon[:, 0] = lon[:, 0] - 1e-8
+def pop_add_cyclic(ds):
+    """Return the (nlat, nlon) variables of `ds` with a cyclic point added
+    (see `PopCyclicRemap`); other variables and coordinates are copied.
+    """
+    remap = PopCyclicRemap.from_dataset(ds)
 
-    #-- periodicity
-    lat = np.concatenate((tlat, tlat), 1)
-    lat = lat[:, xL:xR]
-    lat = np.hstack((lat, lat[:,0:1]))
+    TLAT = xr.DataArray(remap.TLAT, dims=('nlat', 'nlon'))
+    TLONG = xr.DataArray(remap.TLONG, dims=('nlat', 'nlon'))
 
-    TLAT = xr.DataArray(lat, dims=('nlat', 'nlon'))
-    TLONG = xr.DataArray(lon, dims=('nlat', 'nlon'))
-    
     dso = xr.Dataset({'TLAT': TLAT, 'TLONG': TLONG})
 
     # copy vars
@@ -51,27 +173,101 @@ def pop_add_cyclic(ds):
         if not ('nlat' in v_dims and 'nlon' in v_dims):
             dso[v] = ds[v]
         else:
-            # determine and sort other dimensions
-            other_dims = set(v_dims) - {'nlat', 'nlon'}
-            other_dims = tuple([d for d in v_dims if d in other_dims])
-            lon_dim = ds[v].dims.index('nlon')
-            field = ds[v].data
-            field = np.concatenate((field, field), lon_dim)
-            field = field[..., :, xL:xR]
-            field = np.concatenate((field, field[..., :, 0:1]), lon_dim)       
-            dso[v] = xr.DataArray(field, dims=other_dims+('nlat', 'nlon'), 
-                                  attrs=ds[v].attrs)
-
+            dso[v] = remap(ds[v].variable)
 
     # copy coords
     for v, da in ds.coords.items():
         if not ('nlat' in da.dims and 'nlon' in da.dims):
             dso = dso.assign_coords(**{v: da})
-                
-            
+
     return dso
 
 
+class ZonalMean(object):
+    """Area-weighted means over latitude bands of a curvilinear grid.
+
+    Cells are assigned to bands by their latitude and the cell areas are
+    stored in a sparse (band x cell) matrix, so averaging a field is one
+    sparse matrix product for each block of (nlat, nlon) slices. Missing
+    values are excluded from both the sum and the normalizing area.
+
+    Parameters
+    ----------
+    TLAT, TAREA : array_like
+      (nlat, nlon) cell latitude and area.
+    lat_edges : array_like, optional
+      Band edges; defaults to 1-degree bands.
+    mask : array_like, optional
+      (nlat, nlon) boolean; cells outside the mask are excluded.
+    """
+
+    def __init__(self, TLAT, TAREA, lat_edges=None, mask=None):
+        if lat_edges is None:
+            lat_edges = np.arange(-90., 91., 1.)
+        self.lat_edges = np.asarray(lat_edges, dtype=np.float64)
+        self.lat = 0.5 * (self.lat_edges[:-1] + self.lat_edges[1:])
+
+        tlat = np.asarray(TLAT, dtype=np.float64).ravel()
+        area = np.asarray(TAREA, dtype=np.float64).ravel()
+        self.shape = np.shape(TLAT)
+
+        band = np.digitize(tlat, self.lat_edges) - 1
+        keep = (band >= 0) & (band < len(self.lat)) & np.isfinite(area) & (area > 0)
+        if mask is not None:
+            keep &= np.asarray(mask, dtype=bool).ravel()
+
+        cell = np.nonzero(keep)[0]
+        self.matrix = scipy.sparse.csr_matrix((area[cell], (band[cell], cell)),
+                                              shape=(len(self.lat), tlat.size))
+
+    @classmethod
+    def from_grid(cls, TLAT, TAREA, lat_edges=None, mask=None):
+        """Return the (cached) `ZonalMean` for a grid, bands and mask."""
+        arrays = [np.asarray(a) for a in [TLAT, TAREA, lat_edges, mask] if a is not None]
+        key = (np.shape(TLAT), lat_edges is None, mask is None,
+               hashlib.sha1(b''.join(a.tobytes() for a in arrays)).hexdigest())
+        if key not in _zonal_means:
+            _zonal_means[key] = cls(TLAT, TAREA, lat_edges, mask)
+        return _zonal_means[key]
+
+    def _apply(self, field):
+        """Average numpy `field` (..., nlat, nlon) into (..., lat)."""
+        lead = field.shape[:-2]
+        field = field.reshape(-1, self.matrix.shape[1]).T
+        valid = np.isfinite(field)
+
+        total = self.matrix @ np.where(valid, field, 0.)
+        weight = self.matrix @ valid.astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(weight > 0, total / weight, np.nan)
+        return mean.T.reshape(lead + (len(self.lat),))
+
+    def __call__(self, da):
+        """Return the zonal mean of DataArray `da` with dimension `lat`
+        replacing (nlat, nlon); dask arrays are averaged chunk by chunk
+        and must not be chunked along nlat or nlon.
+        """
+        zm = xr.apply_ufunc(self._apply, da,
+                            input_core_dims=[['nlat', 'nlon']],
+                            output_core_dims=[['lat']],
+                            dask='parallelized',
+                            output_dtypes=[np.float64],
+                            dask_gufunc_kwargs={'output_sizes': {'lat': len(self.lat)}},
+                            keep_attrs=True)
+        zm = zm.drop_vars([c for c in zm.coords if c not in zm.dims], errors='ignore')
+        zm['lat'] = xr.DataArray(self.lat, dims='lat',
+                                 attrs={'long_name': 'Latitude', 'units': 'degrees_north'})
+        return zm
+
+
+def zonal_mean(da, TLAT, TAREA, lat_edges=None, mask=None):
+    """Return the area-weighted mean of `da` in latitude bands (see
+    `ZonalMean`), e.g. a zonal-mean section of a (time, z_t, nlat, nlon)
+    field.
+    """
+    return ZonalMean.from_grid(TLAT, TAREA, lat_edges, mask)(da)
+
+
 def label_map_axes(fig, axs):
     """Add letter in upper left of map axes."""
     alp = [chr(i).upper() for i in range(97,97+26)]
@@ -84,22 +280,323 @@ def label_map_axes(fig, axs):
                  fontweight = 'semibold')
         
 def compute_grid_area(ds):
-
+    """Return the area (m^2) of the cells of a regular lat/lon grid from the
+    Gaussian weights `gw`, as a read-only broadcast of the per-latitude
+    area rather than a materialized lat x lon array.
+    """
     Re = 6.37122e6 # m, radius of Earth
 
     # normalize area so that sum over 'lat', 'lon' yields area_earth
-    area = ds.gw + 0.0 * ds.lon # add 'lon' dimension
-    area = (4.0 * np.pi * Re**2 / area.sum(dim=('lat', 'lon'))) * area # m^2
-    area.attrs['units'] = 'm^2'
-    
-    return area        
+    gw = ds.gw.values
+    nlon = ds.sizes['lon']
+    area_lat = (4.0 * np.pi * Re**2 / (gw.sum() * nlon)) * gw # m^2
+    area = np.broadcast_to(area_lat[:, None], (len(gw), nlon))
+
+    coords = {d: ds[d] for d in ['lat', 'lon'] if d in ds.coords}
+    return xr.DataArray(area, dims=('lat', 'lon'), coords=coords,
+                        attrs={'units': 'm^2'})
+
+
+def integrate_budget(ds, area_weights, time_weights, by_year=False):
+    """Integrate fluxes over space and time for a set of regions at once.
+
+    Each variable is contracted with the area and time weights in a single
+    `xr.dot`, so every chunk of the data is read once however many regions
+    are requested; missing values (e.g. land) contribute zero.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset or xarray.DataArray
+      Fluxes per unit area and time; variables without all of the space
+      and time dimensions of the weights are skipped.
+    area_weights : xarray.DataArray
+      Cell area in each region (zero outside it), optionally with a
+      `region` dimension, e.g. `grid_registry.pop_gx1v7().REGION_AREA` or
+      `grid_registry.fv09().AREA`.
+    time_weights : xarray.DataArray
+      1-D length of each time interval, e.g. `time_bound_diff`.
+    by_year : bool, optional
+      Integrate each year separately (requires a datetime-like time
+      coordinate) rather than over all times.
+
+    Returns
+    -------
+    budget : xarray.Dataset
+      Integral of each variable by region (and year).
+    """
+    if isinstance(ds, xr.DataArray):
+        ds = ds.to_dataset()
+
+    time_dim = time_weights.dims[0]
+    dims = [d for d in area_weights.dims if d != 'region'] + [time_dim]
+
+    if by_year:
+        year = ds[time_dim].dt.year.values
+        years = np.unique(year)
+        in_year = xr.DataArray(year[:, None] == years[None, :], dims=(time_dim, 'year'),
+                               coords={'year': years})
+        time_weights = time_weights * in_year
+
+    budget = xr.Dataset()
+    for v in ds.data_vars:
+        if not set(dims) <= set(ds[v].dims):
+            continue
+        budget[v] = xr.dot(ds[v].fillna(0.), area_weights, time_weights, dims=dims)
+        budget[v].attrs = {k: ds[v].attrs[k] for k in ['long_name'] if k in ds[v].attrs}
+    return budget
+
 
 def set_coords(ds, data_vars):
     """Set all variables except varname to be coords."""
     coord_vars = set(ds.data_vars) - set(data_vars)
     return ds.set_coords(coord_vars)
 
-def open_cesm_data(col, data_vars, time_slice=None):
+def _parse_time_units(units):
+    """Return the length of a unit in days and the reference date of CF
+    time `units`, as (year, day of year) in the noleap calendar.
+    """
+    match = re.match(r'\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)'
+                     r'(?:[ T](\d+):(\d+)(?::([\d.]+))?)?', units)
+    if match is None or match.group(1) not in _days_per_unit:
+        raise ValueError(f'cannot parse time units: {units}')
+
+    year, month, day = [int(g) for g in match.group(2, 3, 4)]
+    hour, minute, second = [float(g or 0) for g in match.group(5, 6, 7)]
+    doy = noleap_cumdays[month - 1] + day - 1 + (hour + (minute + second / 60.) / 60.) / 24.
+    return _days_per_unit[match.group(1)], year, doy
+
+
+def decode_noleap_time(time_bound, units):
+    """Decode noleap-calendar time bounds with array arithmetic rather than
+    cftime objects.
+
+    Parameters
+    ----------
+    time_bound : array_like
+      (time, 2) interval bounds in `units`.
+    units : str
+      CF time units, e.g. 'days since 0000-01-01 00:00:00'.
+
+    Returns
+    -------
+    time : dict
+      Arrays `mid` (interval midpoints, in `units`), `year`, `month` and
+      `dt` (interval length, days), plus `days`, the midpoints in days
+      since the start of `year` zero.
+    """
+    scale, ref_year, ref_doy = _parse_time_units(units)
+    time_bound = np.asarray(time_bound, dtype=np.float64)
+
+    mid = time_bound.mean(axis=1)
+    days = mid * scale + ref_doy + ref_year * 365
+    year = np.floor(days / 365).astype(int)
+    doy = days - year * 365
+    month = np.searchsorted(noleap_cumdays[1:], doy, side='right') + 1
+
+    return dict(mid=mid, days=days, year=year, month=month,
+                dt=(time_bound[:, 1] - time_bound[:, 0]) * scale)
+
+
+def _noleap_date_range(date_string):
+    """Return the start and end, in days since the start of year zero, of
+    the year, month or day given by `date_string` ('YYYY[-MM[-DD]]').
+    """
+    parts = [int(p) for p in date_string.split('-')]
+    year, month, day = parts + [1, 1][len(parts) - 1:]
+    start = year * 365 + noleap_cumdays[month - 1] + day - 1
+    if len(parts) == 1:
+        return start, start + 365
+    elif len(parts) == 2:
+        return start, start + noleap_cumdays[month] - noleap_cumdays[month - 1]
+    return start, start + 1
+
+
+def noleap_time_index(time, time_slice):
+    """Return the indices of the times (see `decode_noleap_time`) whose
+    midpoints lie in `time_slice`, a slice of partial date strings as
+    accepted by `Dataset.sel` (e.g. slice('0020', '0032') for years 20
+    through 32).
+    """
+    start = -np.inf
+    if time_slice.start is not None:
+        start = _noleap_date_range(time_slice.start)[0]
+    end = np.inf
+    if time_slice.stop is not None:
+        end = _noleap_date_range(time_slice.stop)[1]
+    return np.nonzero((time['days'] >= start) & (time['days'] < end))[0]
+
+
+def set_noleap_time(ds, time_slice=None):
+    """Set the `time` of `ds` to the midpoints of its bounds, decoded as
+    cftime objects, after selecting `time_slice` by integer index.
+
+    Also adds `time_bound_diff`, the interval length in years. Calendars
+    other than noleap are decoded with cftime.
+    """
+    attrs = dict(ds.time.attrs)
+    units = attrs.pop('units')
+    calendar = attrs.pop('calendar', 'noleap')
+    time_bound = ds[attrs['bounds']]
+
+    if calendar in ['noleap', '365_day']:
+        time = decode_noleap_time(time_bound.values, units)
+        if time_slice is not None:
+            index = noleap_time_index(time, time_slice)
+            ds = ds.isel(time=index)
+            time = {k: v[index] for k, v in time.items()}
+        mid = time['mid']
+        dt = time['dt']
+    else:
+        mid = time_bound.values.mean(axis=1)
+        dt = np.diff(time_bound.values, axis=1)[:, 0] * _parse_time_units(units)[0]
+
+    time_var = xr.Variable('time', cftime.num2date(mid, units, calendar), attrs)
+    time_var.encoding = dict(units=units, calendar=calendar)
+    ds = ds.assign_coords(time=time_var)
+
+    if calendar not in ['noleap', '365_day'] and time_slice is not None:
+        index = ds.indexes['time'].slice_indexer(time_slice.start, time_slice.stop)
+        ds = ds.isel(time=index)
+        dt = dt[index]
+
+    ds['time_bound_diff'] = xr.Variable('time', dt / 365.)
+    return ds
+
+
+def _catalog_date_range(query_results):
+    """Return the first and last date ('YYYY[-MM[-DD]]') covered by the
+    `date_range` ('YYYY[MM[DD]]-YYYY[MM[DD]]') of catalog entries."""
+    def date(d):
+        return '-'.join(p for p in [d[:4], d[4:6], d[6:8]] if p)
+    ranges = [r.split('-') for r in query_results.date_range]
+    return date(min(r[0] for r in ranges)), date(max(r[1] for r in ranges))
+
+
+def open_zarr_tseries(query_results, variable, stores=None):
+    """Open `variable` from the consolidated Zarr store that
+    cesm_hist2tseries.py --zarr writes next to the netCDF timeseries.
+
+    The store holds every variable of the case/stream over all years; its
+    metadata is read once and reused via `stores`. The times are limited
+    to the `date_range` of the catalog entries in `query_results`, so that
+    the result matches the netCDF files they list.
+
+    Returns
+    -------
+    ds : xarray.Dataset or None
+      `variable` with the static variables and time bounds, or None if there
+      is no store, the variable is not in it or the store covers less than
+      the catalog entries.
+    """
+    if stores is None:
+        stores = {}
+
+    row = query_results.iloc[0]
+    store = os.path.join(row.file_dirname, f'{row.case}.{row.stream}.zarr')
+    if store not in stores:
+        if not os.path.exists(store):
+            return None
+        stores[store] = xr.open_zarr(store, consolidated=True, decode_times=False,
+                                     decode_coords=False,
+                                     chunks={'time': 12, 'z_t': 20})
+    ds = stores[store]
+    if variable not in ds.variables:
+        return None
+
+    time_bound = ds.time.attrs.get('bounds')
+    if ds.time.attrs.get('calendar', 'noleap') not in ['noleap', '365_day']:
+        return None
+
+    # select the catalog's dates; give up if the store does not reach them
+    start, end = _catalog_date_range(query_results)
+    time = decode_noleap_time(ds[time_bound].values, ds.time.attrs['units'])
+    index = noleap_time_index(time, slice(start, end))
+    if (not len(index)
+            or time['days'][index[0]] >= _noleap_date_range(start)[1]
+            or time['days'][index[-1]] < _noleap_date_range(end)[0]):
+        return None
+
+    keep = [v for v in ds.data_vars if 'time' not in ds[v].dims or v == time_bound]
+    return ds[keep + [variable]].isel(time=index)
+
+
+def _dataset_cache_key(col, data_vars, time_slice, zarr=False):
+    """Hash the experiments, variables and time slice requested together
+    with the modification time and size of the intake CSV and of every
+    file (or Zarr store metadata) that would be read.
+    """
+    df = col.df[col.df.variable.isin(data_vars)]
+    explist = col.df.experiment.unique().tolist()
+
+    files = [INTAKE_CSV] + sorted(df.file_fullpath.unique())
+    if zarr:
+        for (dirname, case, stream), _ in df.groupby(['file_dirname', 'case', 'stream']):
+            store = os.path.join(dirname, f'{case}.{stream}.zarr')
+            files += [os.path.join(store, 'zarr.json'), os.path.join(store, '.zmetadata')]
+
+    key = hashlib.sha1(repr((explist, list(data_vars), time_slice, zarr)).encode())
+    for f in files:
+        if os.path.exists(f):
+            stat = os.stat(f)
+            key.update(f'{f}:{stat.st_mtime_ns}:{stat.st_size}'.encode())
+        else:
+            key.update(f'{f}:missing'.encode())
+    return key.hexdigest()
+
+
+def open_cesm_data(col, data_vars, time_slice=None, max_workers=8, cache=True,
+                   cache_dir=None, zarr=False):
+    """Open `data_vars` for every experiment in `col` as a single dataset
+    with an `experiment` dimension.
+
+    Datasets are memoized in-process (up to DATASET_CACHE_SIZE) and, if
+    `cache_dir` is given, pickled there with their dask graphs so that a new
+    session skips the catalog searches and file opens. Cache entries are
+    keyed by the request and the modification times of the intake CSV and
+    the data files, so they are invalidated when either changes. Each call
+    returns a deep copy, so in-place changes to it do not reach the cache.
+
+    With `zarr=True`, variables are read from the Zarr store written by
+    cesm_hist2tseries.py --zarr, when it covers the catalog's dates, rather
+    than from the netCDF timeseries files.
+    """
+    if not cache:
+        return _open_cesm_data(col, data_vars, time_slice, max_workers, zarr)
+
+    key = _dataset_cache_key(col, data_vars, time_slice, zarr)
+    if key in _dataset_cache:
+        _dataset_cache.move_to_end(key)
+        return _dataset_cache[key].copy(deep=True)
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f'open_cesm_data.{key}.pkl')
+
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as fid:
+            ds = pickle.load(fid)
+    else:
+        ds = _open_cesm_data(col, data_vars, time_slice, max_workers, zarr)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, 'wb') as fid:
+                pickle.dump(ds, fid)
+
+    _dataset_cache[key] = ds
+    while len(_dataset_cache) > DATASET_CACHE_SIZE:
+        _dataset_cache.popitem(last=False)
+
+    return ds.copy(deep=True)
+
+
+def _open_cesm_data(col, data_vars, time_slice=None, max_workers=8, zarr=False):
+    """Assemble the dataset returned by `open_cesm_data`.
+
+    The file groups of all (experiment, variable) pairs are opened
+    concurrently on `max_workers` threads. Static grid variables (TAREA,
+    KMT, dz, ...) are taken from the first dataset opened and shared by all
+    experiments rather than compared across them.
+    """
 
     # experiment list
     explist = col.df.experiment.unique().tolist()
@@ -108,24 +605,47 @@ def open_cesm_data(col, data_vars, time_slice=None):
                               coords={'experiment': explist}, 
                               name='experiment')
 
-    # construct dataset
-    ds_catlist = []
-    for exp in experiment.values:
-        ds_mergelist = []
-        ds_data_vars = []
+    # find the files for each (experiment, variable)
+    query_results = {}
+    for exp in explist:
         for v in data_vars:
             cat_query = col.search(experiment=exp, variable=v)
             if len(cat_query.query_results) > 0:
-                ds_data_vars.append(v)
-                filename = cat_query.query_results.file_fullpath.tolist()
-                
-                ds = xr.open_mfdataset(filename, decode_times=False, 
-                                       decode_coords=False, 
-                                       chunks={'time': 12, 'z_t': 20})
-                
-                ds_mergelist.append(ds)
-
-        ds_mergelist = [set_coords(ds, ds_data_vars) for ds in ds_mergelist]
+                query_results[exp, v] = cat_query.query_results
+
+    # open all file groups concurrently
+    zarr_stores = {}
+    def open_query(key):
+        exp, v = key
+        ds = None
+        if zarr:
+            ds = open_zarr_tseries(query_results[key], v, zarr_stores)
+        if ds is None:
+            filename = query_results[key].file_fullpath.tolist()
+            ds = xr.open_mfdataset(filename, decode_times=False,
+                                   decode_coords=False, parallel=True,
+                                   chunks={'time': 12, 'z_t': 20})
+        return ds
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        datasets = dict(zip(query_results, pool.map(open_query, query_results)))
+
+    # construct dataset
+    grid_vars = {}
+    ds_catlist = []
+    for exp in explist:
+        ds_data_vars = [v for v in data_vars if (exp, v) in datasets]
+        ds_mergelist = []
+        for v in ds_data_vars:
+            ds = set_coords(datasets[exp, v], ds_data_vars)
+
+            # keep one copy of the static grid variables
+            static_vars = [c for c in ds.coords
+                           if c not in ds.dims and 'time' not in ds[c].dims]
+            for c in static_vars:
+                grid_vars.setdefault(c, ds[c].variable)
+            ds_mergelist.append(ds.drop_vars(static_vars))
+
         if len(ds_mergelist) == 1:
             ds_catlist.append(ds_mergelist[0])
         else:
@@ -148,40 +668,181 @@ def open_cesm_data(col, data_vars, time_slice=None):
         print(f'\tvars: {list(ds.data_vars)}')
     
     ds = xr.concat(ds_list, dim=experiment, data_vars=common_vars)
+    ds = ds.assign_coords(grid_vars)
 
-    ds = ds.esmlab.set_time('time').compute_time_var()
-   
-    if time_slice is not None:
-        ds = ds.sel(time=time_slice)
+    ds = set_noleap_time(ds, time_slice)
 
     non_dim_coords_reset = set(ds.coords) - set(ds.dims)
     ds = ds.reset_coords(non_dim_coords_reset)
-    
-    ds['time_bound_diff'] = ds.time_bound.diff('d2')[:, 0] / 365.
-
-    with xr.set_options(keep_attrs=True):
-        if 'IRON_FLUX' in ds.variables:
-            ds['IRON_FLUX'] = ds.IRON_FLUX * 86400. * 365. * 1e-3
-            ds.IRON_FLUX.attrs['units'] = 'mol m$^{-2}$ yr$^{-1}$'
-
-        if 'photoC_TOT_zint' in ds.variables:
-            ds['photoC_TOT_zint'] = ds.photoC_TOT_zint * 86400. * 365. * 1e-9 * 1e4
-            ds.photoC_TOT_zint.attrs['units'] = 'mol m$^{-2}$ yr$^{-1}$'
-
-        if 'Jint_100m_DIC' in ds.variables:
-            ds['NCP'] = (-1.0) * ds.Jint_100m_DIC * 86400. * 365. * 1e-9 * 1e4
-            ds.NCP.attrs['units'] = 'mol m$^{-2}$ yr$^{-1}$'
-
-        if 'ATM_XTFE_FLUX_CPL' in ds.variables:
-            ds['ATM_XTFE_FLUX_CPL'] = ds.ATM_XTFE_FLUX_CPL / molw_Fe * 1e4 * 86400. * 365.
-            ds.ATM_XTFE_FLUX_CPL.attrs['units'] = 'mol m$^{-2}$ yr$^{-1}$'
-
-        if 'SEAICE_XTFE_FLUX_CPL' in ds.variables:
-            ds['SEAICE_XTFE_FLUX_CPL'] = ds.SEAICE_XTFE_FLUX_CPL / molw_Fe * 1e4 * 86400. * 365.
-            ds.SEAICE_XTFE_FLUX_CPL.attrs['units'] = 'mol m$^{-2}$ yr$^{-1}$'
-
-        if 'Fe' in ds.variables:
-            ds['Fe'] = ds.Fe * 1e3
-            ds.Fe.attrs['units'] = 'nM'
-            ds.Fe.attrs['long_name'] = 'dFe'
-    return ds
\ No newline at end of file
+
+    ds = apply_conversions(ds)
+    return ds
+
+def _time_units(ds):
+    """Return the CF units and calendar of the (possibly decoded) time."""
+    units = ds.time.encoding.get('units', ds.time.attrs.get('units'))
+    calendar = ds.time.encoding.get('calendar', ds.time.attrs.get('calendar', 'noleap'))
+    return units, calendar
+
+
+def _weighted_sums(ds, weights):
+    """Return the time sums of `weights` x data and of the weights where
+    the data are valid.
+    """
+    num = xr.Dataset()
+    den = xr.Dataset()
+    for v in ds.data_vars:
+        valid = ds[v].notnull()
+        num[v] = (ds[v].fillna(0.) * weights).sum('time')
+        den[v] = (valid * weights).sum('time')
+    return num, den
+
+
+def _append_time(path, ds):
+    """Append `ds` to netCDF file `path` along its unlimited `time`."""
+    with netCDF4.Dataset(path, 'a') as nc:
+        n = len(nc.dimensions['time'])
+        nt = ds.sizes['time']
+        for v in ds.variables:
+            if 'time' not in ds[v].dims:
+                continue
+            var = nc.variables[v]
+            data = ds[v].transpose(*var.dimensions).values
+            if v == 'time':
+                data = cftime.date2num(data, var.units, var.calendar)
+            var[n:n + nt, ...] = data
+
+
+def _stream_reduce(ds, freq, out_file=None):
+    """Reduce one experiment to annual means (freq='ann') or a monthly
+    climatology (freq='mon'), loading one year of data at a time.
+
+    Returns the result, or None if it was written to `out_file`.
+    """
+    tmp_file = None
+    if out_file is not None:
+        tmp_file = f'{out_file}.tmp'
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    units, calendar = _time_units(ds)
+    time_bound = ds.time.attrs.get('bounds', 'time_bound')
+    time = decode_noleap_time(ds[time_bound].values, units)
+
+    skip = [time_bound, 'time_bound_diff']
+    time_vars = [v for v in ds.data_vars if 'time' in ds[v].dims and v not in skip]
+    static = ds[[v for v in ds.data_vars if 'time' not in ds[v].dims]].load()
+
+    sums = {}
+    for year in np.unique(time['year']):
+        index = np.nonzero(time['year'] == year)[0]
+        dsy = ds[time_vars].isel(time=index).load()
+        weights = ds.time_bound_diff.isel(time=index).load()
+
+        if freq == 'mon':
+            for month in np.unique(time['month'][index]):
+                in_month = time['month'][index] == month
+                num, den = _weighted_sums(dsy.isel(time=in_month),
+                                          weights.isel(time=in_month))
+                if month in sums:
+                    num, den = num + sums[month][0], den + sums[month][1]
+                sums[month] = num, den
+            continue
+
+        num, den = _weighted_sums(dsy, weights)
+        dso = (num / den).expand_dims('time')
+        for v in time_vars:
+            dso[v].attrs = ds[v].attrs
+
+        tb = ds[time_bound].values[index]
+        tb = np.array([[tb[0, 0], tb[-1, 1]]])
+        time_var = xr.Variable('time', cftime.num2date(tb.mean(axis=1), units, calendar),
+                               ds.time.attrs)
+        dso = dso.assign_coords(time=time_var)
+        dso[time_bound] = (('time', ds[time_bound].dims[-1]), tb)
+
+        if tmp_file is None:
+            sums[year] = dso
+        elif not os.path.exists(tmp_file):
+            dso.merge(static).to_netcdf(tmp_file, unlimited_dims=['time'],
+                                        encoding={'time': dict(units=units, calendar=calendar)})
+        else:
+            _append_time(tmp_file, dso)
+
+    if freq == 'mon':
+        months = sorted(sums)
+        dso = xr.concat([sums[m][0] / sums[m][1] for m in months], dim='month')
+        dso = dso.assign_coords(month=months)
+        for v in time_vars:
+            dso[v].attrs = ds[v].attrs
+    elif tmp_file is None:
+        dso = xr.concat(list(sums.values()), dim='time')
+
+    if tmp_file is None:
+        return dso.merge(static)
+
+    if freq == 'mon':
+        dso.merge(static).to_netcdf(tmp_file)
+    os.rename(tmp_file, out_file)
+
+
+def _stream_reduce_experiments(ds, freq, out_file=None, max_workers=1):
+    """Apply `_stream_reduce` to each experiment of `ds`, optionally in
+    `max_workers` processes.
+    """
+    if 'experiment' not in ds.dims:
+        dso = _stream_reduce(ds, freq, out_file)
+        return dso if out_file is None else xr.open_dataset(out_file)
+
+    explist = ds.experiment.values.tolist()
+    if out_file is not None and '{experiment}' not in out_file:
+        raise ValueError('out_file must contain "{experiment}"')
+
+    args = [(ds.sel(experiment=exp, drop=True), freq,
+             None if out_file is None else out_file.format(experiment=exp))
+            for exp in explist]
+
+    if max_workers > 1:
+        # fresh interpreters: forking after dask has started threads can deadlock
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(args)),
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(_stream_reduce, *zip(*args)))
+    else:
+        results = [_stream_reduce(*a) for a in args]
+
+    # static variables and time bounds are shared by all experiments
+    concat_vars = [v for v in ds.data_vars if 'experiment' in ds[v].dims]
+    concat = dict(data_vars=concat_vars, coords='minimal', compat='override')
+
+    if out_file is not None:
+        files = [a[2] for a in args]
+        return xr.open_mfdataset(files, combine='nested', concat_dim='experiment',
+                                 **concat).assign_coords(experiment=explist)
+
+    return xr.concat(results, dim='experiment', **concat).assign_coords(experiment=explist)
+
+
+def annual_mean(ds, out_file=None, max_workers=1):
+    """Compute annual means of the monthly output of `open_cesm_data`,
+    weighted by `time_bound_diff`, one year of data at a time.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+      Dataset with `time_bound` and `time_bound_diff` (noleap calendar).
+    out_file : str, optional
+      netCDF file to which each year is appended as it is computed;
+      must contain '{experiment}' if `ds` has an experiment dimension.
+      The result is then opened lazily from the file(s).
+    max_workers : int, optional
+      Number of processes over which experiments are distributed.
+    """
+    return _stream_reduce_experiments(ds, 'ann', out_file, max_workers)
+
+
+def monthly_climatology(ds, out_file=None, max_workers=1):
+    """Compute the mean annual cycle (with a `month` dimension) of the
+    monthly output of `open_cesm_data`, accumulating weighted sums one
+    year of data at a time. Parameters are as for `annual_mean`.
+    """
+    return _stream_reduce_experiments(ds, 'mon', out_file, max_workers)